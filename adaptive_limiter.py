@@ -0,0 +1,108 @@
+import time
+import asyncio
+import logging
+import statistics
+import config
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# the median of the last answers is the typical latency, outliers (long prompts or answers) do not move it
+LATENCY_WINDOW = 25
+# the baseline (lowest typical latency) drifts up per answer, so longer prompts of later chunks become the new normal
+BASELINE_DRIFT = 0.002
+
+
+class AdaptiveLimiter:
+    """
+    Limits the AI requests in flight. With adaptive=True the limit follows AIMD:
+    +1 per round of answers, halved (at most once per round trip) on failed requests or when the
+    median latency of the last answers rises above AI_LATENCY_TOLERANCE x its lowest value (queueing in the server).
+    Single slow answers (long prompts or answers) are no congestion, only a rising median is.
+    """
+
+    def __init__(self, initial=config.AI_PARALLEL_REQUESTS, minimum=config.AI_MIN_PARALLEL_REQUESTS,
+                 maximum=config.AI_MAX_PARALLEL_REQUESTS, latency_tolerance=config.AI_LATENCY_TOLERANCE,
+                 adaptive=config.AI_ADAPTIVE_CONCURRENCY):
+        self.adaptive = adaptive
+        self.minimum = max(1, minimum if adaptive else initial)
+        self.maximum = max(self.minimum, maximum if adaptive else initial)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.typical_latency = None
+        self.baseline_latency = None
+        self.last_decrease = 0.0
+        self._loop = None
+        self._condition = None
+
+    def condition(self):
+        # asyncio primitives belong to one event loop, a new asyncio.run() starts with a new one
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            self.in_flight = 0
+        return self._condition
+
+    async def acquire(self):
+        condition = self.condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency, ok):
+        """
+        Frees the slot of a finished request and adapts the limit to its latency and outcome (ok None: no signal).
+        """
+        self.in_flight -= 1
+        if self.adaptive and ok is not None:
+            self.adapt(latency, ok)
+
+        condition = self.condition()
+        async with condition:
+            condition.notify_all()
+
+    def adapt(self, latency, ok):
+        congested = not ok
+        if ok:
+            self.latencies.append(latency)
+            if len(self.latencies) < LATENCY_WINDOW:
+                # no reliable median yet, growing is fine
+                congested = False
+            else:
+                self.typical_latency = statistics.median(self.latencies)
+                if self.baseline_latency is None:
+                    self.baseline_latency = self.typical_latency
+                self.baseline_latency = min(self.typical_latency, self.baseline_latency * (1 + BASELINE_DRIFT))
+                congested = self.typical_latency > self.baseline_latency * self.latency_tolerance
+
+        if not congested:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            return
+
+        # the other requests in flight saw the same congestion, decrease only once per round trip
+        now = time.monotonic()
+        if now - self.last_decrease > latency and self.limit > self.minimum:
+            previous = int(self.limit)
+            self.limit = max(self.minimum, self.limit / 2)
+            self.last_decrease = now
+            # the answers in the window were sent at the old limit, judge the new limit on fresh ones
+            self.latencies.clear()
+            if int(self.limit) != previous:
+                logger.info(f"AI concurrency limit decreased to {int(self.limit)} "
+                            f"({'failed request' if not ok else f'median latency {self.typical_latency:.2f}s'}).")
+
+
+_limiter = None
+
+
+def get_limiter():
+    """
+    Returns the shared limiter of this process.
+    """
+    global _limiter
+    if _limiter is None:
+        _limiter = AdaptiveLimiter()
+    return _limiter
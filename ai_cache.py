@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import logging
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text) -> str:
+    """
+    Normalizes a text before hashing, so whitespace differences hit the same entry.
+    """
+    return ' '.join(str(text).split())
+
+
+def make_key(text, prompt_template: str, model: str) -> str:
+    """
+    Cache key: hash of normalized text, prompt template and model name.
+    A changed prompt or model never reuses answers of the old one.
+    """
+    raw = "\x1f".join([normalize_text(text), prompt_template, model])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def prompt_hash(prompt_template: str, model: str) -> str:
+    return hashlib.sha256(f"{prompt_template}\x1f{model}".encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    Persistent SQLite cache for AI answers with size and age based eviction.
+    Lookups and new answers do not commit: last_used of hits is collected in memory and written with the new
+    answers in one transaction per chunk (flush), so the event loop does not wait for a commit per row.
+    """
+
+    def __init__(self, path=config.AI_CACHE_PATH, max_entries=config.AI_CACHE_MAX_ENTRIES,
+                 max_age_days=config.AI_CACHE_MAX_AGE_DAYS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        # key -> last_used of the hits since the last flush
+        self.used = {}
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " key TEXT PRIMARY KEY,"
+            " prompt_hash TEXT NOT NULL,"
+            " answer TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_last_used ON answers(last_used)")
+        self.conn.commit()
+        self.evict()
+
+    def get(self, key):
+        row = self.conn.execute("SELECT answer FROM answers WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.used[key] = time.time()
+        return row[0]
+
+    def put(self, key, answer: str, prompt_template: str, model: str):
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO answers (key, prompt_hash, answer, created, last_used) VALUES (?, ?, ?, ?, ?)",
+            (key, prompt_hash(prompt_template, model), answer, now, now),
+        )
+
+    def flush(self):
+        """
+        Writes the collected last_used times and commits them together with the new answers.
+        """
+        if self.used:
+            self.conn.executemany("UPDATE answers SET last_used = ? WHERE key = ?",
+                                  [(used, key) for key, used in self.used.items()])
+            self.used = {}
+        self.conn.commit()
+
+    def evict(self):
+        """
+        Removes entries older than max_age_days and the least recently used entries above max_entries.
+        """
+        removed = 0
+        if self.max_age_days:
+            cutoff = time.time() - self.max_age_days * 86400
+            removed += self.conn.execute("DELETE FROM answers WHERE last_used < ?", (cutoff,)).rowcount
+
+        if self.max_entries:
+            removed += self.conn.execute(
+                "DELETE FROM answers WHERE key IN ("
+                " SELECT key FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+
+        self.conn.commit()
+        if removed:
+            logger.info(f"AI cache: {removed} entries evicted.")
+
+    def invalidate(self, prompt_template: str = None, model: str = None):
+        """
+        Deletes all entries, or only the entries of one prompt template and model.
+        """
+        if prompt_template is None:
+            removed = self.conn.execute("DELETE FROM answers").rowcount
+        else:
+            removed = self.conn.execute(
+                "DELETE FROM answers WHERE prompt_hash = ?", (prompt_hash(prompt_template, model),)
+            ).rowcount
+        self.conn.commit()
+        logger.info(f"AI cache: {removed} entries invalidated.")
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0.0
+        logger.info(f"AI cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), {len(self)} entries.")
+
+    def close(self):
+        self.flush()
+        self.evict()
+        self.conn.close()
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    Returns the shared cache of this process, or None if ENABLE_AI_CACHE is off.
+    """
+    global _cache
+    if not config.ENABLE_AI_CACHE:
+        return None
+    if _cache is None:
+        _cache = AnswerCache()
+    return _cache
+
+
+if __name__ == "__main__":
+    # python ai_cache.py          -> show entry count
+    # python ai_cache.py clear    -> delete all cached answers (e.g. after a prompt change)
+    logging.basicConfig(level=logging.INFO)
+    cache = AnswerCache()
+    if len(sys.argv) > 1 and sys.argv[1] == "clear":
+        cache.invalidate()
+    cache.log_stats()
+    cache.close()
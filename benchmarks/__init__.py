@@ -0,0 +1,5 @@
+# Benchmarks and synthetic test data for the extraction pipeline.
+#
+#   python -m benchmarks.generate_corpus --rows 10000 --output benchmarks/data/dla_10000.csv
+#   python -m benchmarks.run_benchmarks --rows 10000 1000000
+#   python -m benchmarks.fake_lmstudio --port 1235 --latency-mean 0.5 --slots 4 --error-rate 0.05
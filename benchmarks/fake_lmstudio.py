@@ -0,0 +1,189 @@
+import re
+import json
+import math
+import random
+import asyncio
+import hashlib
+import logging
+import argparse
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# numbered texts of a batch prompt: "0: text"
+BATCH_LINE_PATTERN = re.compile(r"^(\d+): (.*)$", re.MULTILINE)
+# years at the start of a digit run, also of compact dates like 20110512
+YEAR_PATTERN = re.compile(r"(?<!\d)(19\d\d|20\d\d|2100)")
+# the text of a single prompt follows the last of these markers of the templates
+TEXT_MARKER_PATTERN = re.compile(r"'Year': |Text: ")
+RAMBLE = " Die Jahreszahl wurde aus dem Dateinamen und den Kapitelangaben abgeleitet, weitere Zeitstempel sind nicht erkennbar."
+
+
+class FakeLMStudio:
+    """
+    OpenAI compatible stub of the LM Studio chat completions endpoint for load and latency tests.
+    Answers are derived from the prompt text and are the same for the same text on every run,
+    latency, errors and timeouts are drawn from the configured distributions.
+    """
+
+    def __init__(self, latency="lognormal", latency_mean=0.5, latency_sigma=0.5, per_text_latency=0.05,
+                 slots=4, error_rate=0.0, timeout_rate=0.0, hang_seconds=120.0, hallucination_rate=0.1, seed=42,
+                 token_latency=0.0, ramble_rate=0.0):
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.per_text_latency = per_text_latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.hallucination_rate = hallucination_rate
+        # decode time per generated token, free text answers go on up to max_tokens with ramble_rate
+        self.token_latency = token_latency
+        self.ramble_rate = ramble_rate
+        self.random = random.Random(seed)
+        # requests beyond the slots wait, like in LM Studio
+        self.slots = asyncio.Semaphore(slots)
+        self.stats = {"requests": 0, "answered": 0, "errors": 0, "timeouts": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def draw_latency(self, text_count):
+        if self.latency == "fixed":
+            base = self.latency_mean
+        elif self.latency == "uniform":
+            base = self.random.uniform(0, 2 * self.latency_mean)
+        else:
+            # lognormal with the given mean, long tail like a real model server
+            base = self.random.lognormvariate(0, self.latency_sigma) * self.latency_mean / math.exp(self.latency_sigma ** 2 / 2)
+        return base + self.per_text_latency * max(0, text_count - 1)
+
+    def answer_year(self, text):
+        """
+        Latest year in the text, sometimes a made up year (hallucination_rate) and otherwise None.
+        """
+        years = YEAR_PATTERN.findall(text)
+        if years:
+            return max(years)
+
+        digest = int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16)
+        if digest % 1000 < self.hallucination_rate * 1000:
+            return str(1950 + digest % 90)
+        return None
+
+    def answer(self, prompt, structured=False):
+        batch = BATCH_LINE_PATTERN.findall(prompt)
+        if batch:
+            items = [{"i": int(i), "year": int(year) if year else None}
+                     for i, year in ((i, self.answer_year(text)) for i, text in batch)]
+            return json.dumps(items), len(batch)
+
+        text = TEXT_MARKER_PATTERN.split(prompt)[-1]
+        year = self.answer_year(text)
+        if structured:
+            return json.dumps({"year": int(year) if year else None}), 1
+
+        content = f"'Year': {year if year else 'null'}"
+        if self.random.random() < self.ramble_rate:
+            content += RAMBLE * 10
+        return content, 1
+
+    @staticmethod
+    def limit_output(content, payload):
+        """
+        Applies the stop sequences and max_tokens (about 4 characters per token) of the request.
+        """
+        for stop in payload.get("stop") or []:
+            if stop in content:
+                content = content[:content.index(stop)]
+        max_tokens = payload.get("max_tokens")
+        return content[:max_tokens * 4] if max_tokens else content
+
+    async def chat_completions(self, request):
+        payload = await request.json()
+        prompt = payload["messages"][-1]["content"]
+        self.stats["requests"] += 1
+
+        async with self.slots:
+            self.stats["in_flight"] += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+            try:
+                content, text_count = self.answer(prompt, structured="response_format" in payload)
+                content = self.limit_output(content, payload)
+                draw = self.random.random()
+                if draw < self.timeout_rate:
+                    self.stats["timeouts"] += 1
+                    await asyncio.sleep(self.hang_seconds)
+                elif draw < self.timeout_rate + self.error_rate:
+                    self.stats["errors"] += 1
+                    await asyncio.sleep(self.draw_latency(1))
+                    return web.json_response({"error": "injected error"}, status=500)
+                else:
+                    await asyncio.sleep(self.draw_latency(text_count) + self.token_latency * len(content) / 4)
+            finally:
+                self.stats["in_flight"] -= 1
+
+        self.stats["answered"] += 1
+        return web.json_response({
+            "object": "chat.completion",
+            "model": payload.get("model", ""),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4},
+        })
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def get_models(self, request):
+        # health check of the endpoint pool, unavailable with error_rate 1
+        if self.error_rate >= 1:
+            return web.json_response({"error": "fake server error"}, status=503)
+        return web.json_response({"object": "list", "data": [{"id": "fake-model", "object": "model"}]})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/stats", self.get_stats)
+        app.router.add_get("/v1/models", self.get_models)
+        return app
+
+
+async def start_fake_server(host="127.0.0.1", port=0, **options):
+    """
+    Starts the fake server in the running event loop, port 0 picks a free port.
+    Returns (runner, server, url of the chat completions endpoint), stop it with runner.cleanup().
+    """
+    server = FakeLMStudio(**options)
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, server, f"http://{host}:{port}/v1/chat/completions"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake LM Studio server for offline load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1235)
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-mean", type=float, default=0.5, help="seconds per request")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="spread of the lognormal latency")
+    parser.add_argument("--per-text-latency", type=float, default=0.05, help="extra seconds per additional text of a batch")
+    parser.add_argument("--slots", type=int, default=4, help="requests processed at the same time")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with HTTP 500")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="share of requests that hang for --hang-seconds")
+    parser.add_argument("--hang-seconds", type=float, default=120.0)
+    parser.add_argument("--hallucination-rate", type=float, default=0.1, help="share of texts without year answered with a made up year")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per generated token")
+    parser.add_argument("--ramble-rate", type=float, default=0.0, help="share of free text answers that go on up to max_tokens")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    fake = FakeLMStudio(
+        latency=args.latency, latency_mean=args.latency_mean, latency_sigma=args.latency_sigma,
+        per_text_latency=args.per_text_latency, slots=args.slots, error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate, hang_seconds=args.hang_seconds,
+        hallucination_rate=args.hallucination_rate, seed=args.seed,
+        token_latency=args.token_latency, ramble_rate=args.ramble_rate,
+    )
+    print(f"Fake LM Studio on http://{args.host}:{args.port}/v1/chat/completions (stats on /stats)")
+    web.run_app(fake.app(), host=args.host, port=args.port, print=None)
@@ -0,0 +1,125 @@
+import os
+import random
+import argparse
+
+# same layout as the dla.csv export: ';'-separated, id, filename, parent, Parent1..Parent13 and other wide columns
+META_COLUMNS = ["id", "filename", "parent"] + [f"Parent{i}" for i in range(1, 14)]
+EXTRA_COLUMNS = [f"attribute_{i}" for i in range(1, 9)]
+
+CHAPTERS = [
+    "7. Gebäude-, Grundstückszustand", "7.3. Flächenberechnung", "7.4. Baubeschreibung", "7.4.1 Baubeschreibung intern",
+    "5. Weitere Rechte und Ansprüche Dritter", "5.2. Nachbarschaftsvereinbarungen", "3. Mietverträge", "3.1 Mieterliste",
+    "2. Grundbuch", "9. Sonstiges",
+]
+WORDS = ["Baubeschreibung", "Flächenberechnung", "Mietvertrag", "Nachtrag", "Protokoll", "Plan", "EG", "OG", "DG",
+         "intern", "final", "Rights of Light - Basic Information", "Gutachten", "Übergabe"]
+EXTENSIONS = [".pdf", ".doc", ".docx", ".xlsx", ".tif", ".zip"]
+
+# default mix of the date formats in the filename, the rest is undated
+DEFAULT_MIX = {
+    "iso": 0.15,
+    "european": 0.15,
+    "compact": 0.25,
+    "quarterly": 0.05,
+    "year_only": 0.10,
+}
+
+
+def random_date(rng):
+    year = rng.randint(1950, 2024)
+    return year, rng.randint(1, 12), rng.randint(1, 28)
+
+
+def date_token(rng, kind):
+    year, month, day = random_date(rng)
+    if kind == "iso":
+        return f"{year}-{month:02d}-{day:02d}"
+    if kind == "european":
+        return f"{day:02d}.{month:02d}.{year}"
+    if kind == "compact":
+        return rng.choice([f"{year}{month:02d}{day:02d}", f"{day:02d}{month:02d}{year}"])
+    if kind == "quarterly":
+        return rng.choice([f"Q{rng.randint(1, 4)}/{year % 100:02d}", f"Q{rng.randint(1, 4)}-{year}", f"{year}Q{rng.randint(1, 4)}"])
+    if kind == "year_only":
+        # ambiguous for the rules, typical input for the AI
+        return f"von {year}"
+    return ""
+
+
+def random_row(rng, row_id, mix):
+    we_number = f"{rng.randint(1, 2500):04d}"
+    kind = rng.choices(list(mix) + ["none"], weights=list(mix.values()) + [max(0.0, 1 - sum(mix.values()))])[0]
+    token = date_token(rng, kind)
+
+    name_parts = [we_number, rng.choice(WORDS)] + ([token] if token else [])
+    filename = "_".join(name_parts).replace(" ", "-") + rng.choice(EXTENSIONS)
+
+    depth = rng.randint(1, 13)
+    chapters = rng.sample(CHAPTERS, k=min(depth, len(CHAPTERS)))
+    parents = [f"({rng.randint(10000, 99999)}) {chapter}" if rng.random() < 0.2 else chapter for chapter in chapters]
+    parents += [""] * (13 - len(parents))
+
+    extras = [rng.choice(["", "x", str(rng.randint(0, 10 ** 6)), "lorem ipsum dolor sit amet" * rng.randint(1, 4)])
+              for _ in EXTRA_COLUMNS]
+
+    return [str(row_id), filename, f"{rng.randint(1, 9999)} WE {we_number}", *parents, *extras]
+
+
+def generate_corpus(output_path, rows, seed=42, duplicate_ratio=0.3, mix=None):
+    """
+    Writes a dla.csv shaped file with `rows` rows.
+
+    Args:
+        output_path: target csv path
+        rows: number of data rows
+        seed: random seed, the same seed gives the same file
+        duplicate_ratio: share of rows that repeat filename and parent chain of an earlier row (new id)
+        mix: share per date format in the filename (see DEFAULT_MIX), the rest is undated
+    """
+    mix = DEFAULT_MIX if mix is None else mix
+    rng = random.Random(seed)
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+    recent = []
+    with open(output_path, "w", encoding="utf-8", newline="\n") as f:
+        f.write(";".join(META_COLUMNS + EXTRA_COLUMNS) + "\n")
+        for row_id in range(1, rows + 1):
+            if recent and rng.random() < duplicate_ratio:
+                row = [str(row_id)] + rng.choice(recent)[1:]
+            else:
+                row = random_row(rng, row_id, mix)
+                recent.append(row)
+                if len(recent) > 1000:
+                    recent.pop(rng.randrange(len(recent)))
+            f.write(";".join(row) + "\n")
+
+    return output_path
+
+
+def corpus_path(rows, seed=42):
+    return os.path.join(os.path.dirname(__file__), "data", f"dla_{rows}_{seed}.csv")
+
+
+def ensure_corpus(rows, seed=42):
+    """
+    Path of a generated corpus, generated only if it does not exist yet.
+    """
+    path = corpus_path(rows, seed)
+    if not os.path.exists(path):
+        generate_corpus(path, rows, seed=seed)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic dla.csv shaped metadata file.")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--duplicates", type=float, default=0.3, help="share of duplicated filename/parent chains")
+    for kind, share in DEFAULT_MIX.items():
+        parser.add_argument(f"--{kind.replace('_', '-')}", type=float, default=share, help=f"share of {kind} dates")
+    args = parser.parse_args()
+
+    mix = {kind: getattr(args, kind) for kind in DEFAULT_MIX}
+    path = generate_corpus(args.output or corpus_path(args.rows, args.seed), args.rows, args.seed, args.duplicates, mix)
+    print(f"Corpus with {args.rows} rows written: {path}")
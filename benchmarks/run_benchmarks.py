@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks.generate_corpus import ensure_corpus
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARKS = ["extract_latest_year", "extract_latest_years", "select_meta_cols", "split_csv_by_size", "shipping", "pipeline",
+              "ai_requests"]
+
+# distinct rule misses sent to the fake LM Studio server in the ai_requests benchmark
+AI_BENCHMARK_TEXTS = 2000
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB, None where the resource module is missing (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def combined_texts(corpus):
+    from select_and_combine_metadata import read_meta_chunks, combine_meta_cols
+
+    return [text for chunk in read_meta_chunks(corpus, 100000) for text in combine_meta_cols(chunk)['combined']]
+
+
+def write_combined_csv(corpus):
+    from select_and_combine_metadata import select_meta_cols
+
+    os.makedirs("tmp", exist_ok=True)
+    return select_meta_cols(corpus, os.path.join("tmp", "selected_combined_meta_cols.csv"), create_csv=True)
+
+
+def bench_extract_latest_year(corpus):
+    from get_latest_year import extract_latest_year
+
+    texts = combined_texts(corpus)
+    start = time.perf_counter()
+    for text in texts:
+        extract_latest_year(text)
+    return len(texts), time.perf_counter() - start
+
+
+def bench_extract_latest_years(corpus):
+    import pandas as pd
+    from get_latest_year import extract_latest_years
+
+    texts = pd.Series(combined_texts(corpus))
+    start = time.perf_counter()
+    extract_latest_years(texts)
+    return len(texts), time.perf_counter() - start
+
+
+def bench_select_meta_cols(corpus):
+    import pandas as pd
+
+    start = time.perf_counter()
+    output_path = write_combined_csv(corpus)
+    elapsed = time.perf_counter() - start
+    return sum(len(chunk) for chunk in pd.read_csv(output_path, chunksize=100000)), elapsed
+
+
+def bench_split_csv_by_size(corpus):
+    import config
+    from csv_file_operations import split_csv_by_size
+
+    combined_csv = write_combined_csv(corpus)
+    rows = sum(1 for _ in open(combined_csv, encoding="utf-8")) - 1
+
+    start = time.perf_counter()
+    split_csv_by_size(combined_csv, "csv_parts", max_rows=config.CSV_SPILT_FILE_ROWS)
+    return rows, time.perf_counter() - start
+
+
+def bench_shipping(corpus):
+    import config
+    import pandas as pd
+    from get_latest_year import extract_latest_years
+    from csv_file_operations import generate_shipping_files_streaming
+
+    # result files like main_async writes them, one per 100k rows
+    combined_csv = write_combined_csv(corpus)
+    os.makedirs(config.OUTPUT_DIR, exist_ok=True)
+    os.makedirs(config.SHIPPING_DIR, exist_ok=True)
+    rows = 0
+    for part, chunk in enumerate(pd.read_csv(combined_csv, chunksize=100000), start=1):
+        chunk['year'] = extract_latest_years(chunk['combined'])
+        chunk['origin'] = chunk['year'].map(lambda year: "RULE" if year else "AI")
+        chunk['year'] = chunk['year'].replace("", "0")
+        chunk[['id', 'year', 'origin']].to_csv(os.path.join(config.OUTPUT_DIR, f"extracted_years_part_{part}.csv"), index=False)
+        rows += len(chunk)
+
+    start = time.perf_counter()
+    generate_shipping_files_streaming(config.OUTPUT_DIR, [], combined_csv,
+                                      os.path.join(config.SHIPPING_DIR, "raw.csv"),
+                                      os.path.join(config.SHIPPING_DIR, "verified.csv"),
+                                      blacklist_years=config.AI_YEAR_BLACKLIST)
+    return rows, time.perf_counter() - start
+
+
+def bench_pipeline(corpus):
+    import config
+
+    # rules only, AI answers would dominate and depend on the model server
+    config.ENABLE_AI_PROCESS = False
+    config.ENABLE_AI_CACHE = False
+    config.STREAMING_MODE = True
+    config.TEST_MODE_ACTIVATED = False
+    config.FILENAME_META_PRD = os.path.basename(corpus)
+    os.makedirs("data", exist_ok=True)
+    shutil.copy(corpus, os.path.join("data", config.FILENAME_META_PRD))
+
+    import main
+
+    rows = sum(1 for _ in open(corpus, encoding="utf-8")) - 1
+    start = time.perf_counter()
+    asyncio.run(main.main_async())
+    return rows, time.perf_counter() - start
+
+
+def bench_ai_requests(corpus):
+    import config
+    import pandas as pd
+    import prompt_lmstudio
+    from endpoint_pool import set_endpoints
+    from get_latest_year import extract_latest_years
+    from year_extracting import ask_ai_for_years
+    from benchmarks.fake_lmstudio import start_fake_server
+
+    config.ENABLE_AI_CACHE = False
+    texts = pd.Series(combined_texts(corpus))
+    texts = texts[extract_latest_years(texts) == ""].drop_duplicates().head(AI_BENCHMARK_TEXTS).tolist()
+
+    async def run():
+        runner, server, url = await start_fake_server(
+            latency_mean=0.02, per_text_latency=0.005, slots=config.AI_PARALLEL_REQUESTS)
+        set_endpoints([{"url": url}])
+        try:
+            async with prompt_lmstudio.create_session() as session:
+                start = time.perf_counter()
+                await ask_ai_for_years(session, texts)
+                return time.perf_counter() - start
+        finally:
+            await runner.cleanup()
+
+    return len(texts), asyncio.run(run())
+
+
+def run_single(name, rows, seed):
+    """
+    Runs one benchmark in this process (inside an empty working directory) and prints a json result line.
+    """
+    corpus = os.path.abspath(ensure_corpus(rows, seed))
+    sys.path.insert(0, REPO_DIR)
+
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    os.chdir(work_dir)
+    try:
+        import logging_config
+
+        logging_config.setup_logging(log_dir=os.path.join(work_dir, "logs"), level=logging.WARNING)
+        processed, elapsed = globals()[f"bench_{name}"](corpus)
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    result = {
+        "benchmark": name,
+        "rows": processed,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(processed / elapsed, 1) if elapsed else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1) if peak_rss_mb() is not None else None,
+    }
+    print(json.dumps(result))
+
+
+def run_all(names, sizes, seed):
+    """
+    Every benchmark runs in its own subprocess, so the peak RSS belongs to that benchmark only.
+    """
+    results = []
+    for rows in sizes:
+        print(f"Corpus with {rows} rows: {ensure_corpus(rows, seed)}")
+        for name in names:
+            completed = subprocess.run(
+                [sys.executable, "-m", "benchmarks.run_benchmarks", "--single", name, "--rows", str(rows), "--seed", str(seed)],
+                cwd=REPO_DIR, capture_output=True, text=True,
+            )
+            if completed.returncode != 0:
+                print(f"ERROR {name} ({rows} rows):\n{completed.stderr}")
+                continue
+
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print(f"  {name:<22} {result['rows']:>10} rows {result['seconds']:>10.2f} s "
+                  f"{result['rows_per_sec'] or 0:>12.1f} rows/sec  peak RSS {result['peak_rss_mb']} MB")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the extraction pipeline on synthetic data.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 1000000, 10000000])
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", default=None, help="write all results to this json file")
+    parser.add_argument("--single", choices=BENCHMARKS, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.single, args.rows[0], args.seed)
+    else:
+        all_results = run_all(args.benchmarks, args.rows, args.seed)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(all_results, f, indent=2)
@@ -7,14 +7,44 @@ TEST_MODE_ACTIVATED = False
 FILENAME_META_PRD = "dla.csv"
 FILENAME_META_TST = "dla_short_test.csv"
 
+# ROWS READ AT ONCE FROM THE META DATA CSV DURING THE TRANSFORMATION. LIMITS THE MEMORY USAGE.
+# ONLY THE COLUMNS id, filename, parent AND Parent2..Parent13 ARE READ.
+META_READ_CHUNK_ROWS = 100000
+
+# CSV PARSER FOR THE META DATA CSV: "c" (PANDAS DEFAULT) OR "pyarrow" (FASTER, NEEDS "pip install pyarrow")
+META_CSV_ENGINE = "c"
+
 # SPLITS BIG META DATA CSV IN SMALL PARTS
 # DEFINE THE NUMBER OF ROWS FOR EACH CHUNK.
 # ZERO DISABLES META DATA FILE SPLITTING
 CSV_SPILT_FILE_ROWS = 1000
 
+# STREAMING MODE READS THE META DATA CSV IN CHUNKS OF CSV_SPILT_FILE_ROWS ROWS AND WRITES THE RESULTS DIRECTLY.
+# NO INTERMEDIATE FILES ARE WRITTEN TO TMP AND CSV_PARTS, ONLY ONE CHUNK IS KEPT IN MEMORY.
+# FALSE USES THE PART FILE MODE (TRANSFORM, SPLIT, PROCESS PART FILES).
+STREAMING_MODE = False
+
 # ASK YES OR NO BEFORE PROCESSING THE NEXT CHUNK
 PROMPT_AFTER_CHUNK = False
 
+# PIPELINE MODE: READING, RULES, AI AND WRITING OF DIFFERENT CHUNKS OVERLAP. THE NEXT CHUNKS ARE READ AND RULE-PROCESSED
+# (IN THREADS) WHILE THE AI ANSWERS. THE AI STAGE TAKES THE REMAINING ROWS OF UP TO PIPELINE_AI_MAX_CHUNKS WAITING CHUNKS
+# IN ONE CALL (AI_CHUNK_BUDGET_SECONDS APPLIES TO THE CALL) AND RUNS UP TO PIPELINE_AI_CONCURRENT_CALLS CALLS AT THE SAME TIME.
+# AT MOST PIPELINE_PREFETCH_CHUNKS CHUNKS WAIT BETWEEN TWO STAGES. NOT USED WITH PROMPT_AFTER_CHUNK.
+PIPELINE_MODE = True
+PIPELINE_PREFETCH_CHUNKS = 2
+PIPELINE_AI_MAX_CHUNKS = 4
+PIPELINE_AI_CONCURRENT_CALLS = 2
+
+# ROW LEVEL JOURNAL OF ALL RESULTS (id, year, origin), WRITTEN WHILE A CHUNK IS PROCESSED.
+# AFTER A CRASH THE NEXT RUN SKIPS ALL IDS IN THE JOURNAL. A NEW META FILE TRANSFORMATION STARTS A NEW JOURNAL,
+# IN STREAMING_MODE THE RUN ASKS AT STARTUP WHETHER TO RESUME OR TO START A NEW JOURNAL.
+# SHIPPING GENERATION USES THE JOURNAL AS ADDITIONAL RESULT SOURCE.
+ENABLE_RESULT_JOURNAL = True
+RESULT_JOURNAL_PATH = "tmp/result_journal.csv"
+RESULT_JOURNAL_FLUSH_ROWS = 50
+RESULT_JOURNAL_FLUSH_SECONDS = 10
+
 # ENABLED OR DISABLES CLEANING THE OUTPUT FOLDER WHEN THE PROGRAM STARTS.
 # SETTING THIS TO TRUE ACTIVATES THE CLEANUP AND THE PRIOR BACKUP OF THE DATA.
 # BACKED-UP DATA WILL BE MOVED TO THE BACKUP FOLDER WITH A TIMESTAMP.
@@ -23,11 +53,21 @@ CLEAN_OUTPUT_FOLDER_AT_STARTUP = False
 # OUTPUT FOLDER FOR RESULT FILES
 OUTPUT_DIR = "output"
 
+# FORMAT OF THE RESULT FILES: "csv" WRITES ONE CSV PER CHUNK.
+# "parquet" WRITES ONE PARQUET FILE PER RUN WITH ONE ROW GROUP PER CHUNK AND TYPED COLUMNS
+# (INTEGER id, UINT16 year, CATEGORICAL origin). NEEDS "pip install pyarrow".
+# THE PARQUET FILE IS ONLY READABLE AFTER THE RUN HAS FINISHED (FOOTER), THE CHUNKS OF A CRASHED RUN ARE ONLY IN THE
+# RESULT JOURNAL: "parquet" NEEDS ENABLE_RESULT_JOURNAL = True.
+RESULT_STORE_FORMAT = "csv"
+
 # OUTPUT FOLDER FOR SHIPPING FILES
 SHIPPING_DIR = "shipping"
 SHIPPING_FILENAME = "extracted_years"
 ADD_COMBINED_ROW = False
 
+# MEMORY BUDGET FOR SORTING DURING SHIPPING GENERATION. BIGGER DATA IS SORTED IN RUN FILES UNDER TMP.
+SHIPPING_MEMORY_BUDGET_MB = 512
+
 # DEFAULT VALUE IF NO YEAR VALUE WAS FOUND
 NOT_FOUND_RETURN_VALUE = "0"
 
@@ -36,6 +76,128 @@ NOT_FOUND_RETURN_VALUE = "0"
 # YEARS DUE TO MISINTERPRETATION BY THE AI.
 ENABLE_AI_PROCESS = True
 
+# ROWS WITHOUT RULE BASED YEAR AND WITHOUT ANY NUMBER THAT COULD BE A YEAR (TWO DIGIT NUMBER OR A NUMBER
+# CONTAINING 1900..2100, NOT AFTER "WE ") GET YEAR "0" WITH ORIGIN "FILTER" AND ARE NOT SENT TO THE AI.
+ENABLE_AI_CANDIDATE_FILTER = True
+
+# AI YEARS ARE VALIDATED RIGHT AFTER THE MODEL ANSWERED. EACH ROW GETS A CONFIDENCE BETWEEN 0 AND 1:
+# 0.0 NO VALID YEAR, BLACKLISTED YEAR OR "WE" NUMBER COLLISION ("WE 2011", "WE 0011"),
+# 1.0 YEAR OCCURS IN THE TEXT, 0.6 ONLY ITS LAST TWO DIGITS OCCUR, 0.2 NEITHER.
+# YEARS BELOW AI_MIN_CONFIDENCE ARE REPLACED BY "0". 0 KEEPS ALL AI YEARS.
+AI_MIN_CONFIDENCE = 0.5
+# THE AI IS NOT 100% ACCURATE; IT RECOGNIZES SOME KNOWN YEARS EVEN THOUGH THE DATA DOES NOT CONTAIN THEM.
+AI_YEAR_BLACKLIST = {"1900", "2025", "2027", "2029", "2031", "2032", "2033", "2037", "2039", "2040", "2093", "2100"}
+# ASK AGAIN WITH A STRICTER PROMPT IF THE AI FOUND A YEAR WITH LOW CONFIDENCE
+AI_RETRY_LOW_CONFIDENCE = False
+
+# MODEL CASCADE: THE SMALL MODEL AI_SMALL_MODEL_NAME ANSWERS FIRST, ONLY ROWS WITHOUT ANSWER, WITHOUT VALID YEAR OR WITH A
+# CONFIDENCE BELOW AI_CASCADE_MIN_CONFIDENCE (1.0: THE YEAR MUST OCCUR IN THE TEXT) ARE ASKED AGAIN WITH THE LARGE MODEL
+# (AI_MODEL_NAME / MODEL OF THE ENDPOINTS). ORIGIN IS "AI_SMALL" OR "AI_LARGE". THE ENDPOINTS MUST SERVE BOTH MODELS.
+AI_CASCADE = False
+AI_SMALL_MODEL_NAME = "qwen2.5-1.5b-instruct"
+AI_CASCADE_MIN_CONFIDENCE = 1.0
+
+# OPENAI COMPATIBLE CHAT COMPLETIONS ENDPOINT OF LM STUDIO AND TIMEOUT OF ONE REQUEST IN SECONDS.
+# FOR OFFLINE LOAD TESTS START THE FAKE SERVER ("python -m benchmarks.fake_lmstudio --port 1235")
+# AND SET "http://localhost:1235/v1/chat/completions".
+AI_API_URL = "http://localhost:1234/v1/chat/completions"
+AI_MODEL_NAME = "dein-modell-name"
+AI_REQUEST_TIMEOUT_SECONDS = 60
+
+# SEVERAL MODEL SERVERS (GPUS / HOSTS): EVERY REQUEST GOES TO THE HEALTHY ENDPOINT WITH THE FEWEST REQUESTS IN FLIGHT.
+# ONE DICT PER SERVER: "url", OPTIONAL "model" (DEFAULT AI_MODEL_NAME), "max_parallel" (DEFAULT AI_PARALLEL_REQUESTS)
+# AND "name". EMPTY USES AI_API_URL ONLY (LIMITED BY AI_MAX_PARALLEL_REQUESTS). EXAMPLE:
+# AI_ENDPOINTS = [{"url": "http://gpu1:1234/v1/chat/completions", "max_parallel": 4},
+#                 {"url": "http://gpu2:1234/v1/chat/completions", "max_parallel": 2}]
+# AI_MAX_PARALLEL_REQUESTS STAYS THE LIMIT OF ALL ENDPOINTS TOGETHER.
+AI_ENDPOINTS = []
+# AN ENDPOINT IS EJECTED AFTER AI_ENDPOINT_MAX_FAILURES FAILED REQUESTS IN A ROW OR A FAILED HEALTH CHECK (GET .../v1/models
+# EVERY AI_HEALTH_CHECK_INTERVAL_SECONDS) AND RE-ADMITTED AFTER AI_ENDPOINT_EJECT_SECONDS OR A SUCCESSFUL HEALTH CHECK.
+AI_ENDPOINT_MAX_FAILURES = 3
+AI_ENDPOINT_EJECT_SECONDS = 30
+AI_HEALTH_CHECK_INTERVAL_SECONDS = 15
+AI_HEALTH_CHECK_TIMEOUT_SECONDS = 5
+
+# HTTP CONNECTIONS OF THE AI CLIENT: KEEP-ALIVE CONNECTIONS ARE REUSED, AT MOST AI_CONNECTIONS_PER_HOST PER SERVER
+# (SHOULD BE ABOVE ITS MAX_PARALLEL, HEDGED REQUESTS NEED ONE MORE).
+AI_CONNECTIONS_PER_HOST = 32
+AI_KEEPALIVE_SECONDS = 60
+
+# NUMBER OF AI REQUESTS KEPT IN FLIGHT AT THE SAME TIME.
+# SHOULD MATCH THE NUMBER OF PARALLEL SLOTS CONFIGURED IN LM STUDIO.
+AI_PARALLEL_REQUESTS = 3
+
+# ADAPTIVE CONCURRENCY (AIMD): STARTS WITH AI_PARALLEL_REQUESTS, ADDS ONE REQUEST PER ROUND OF ANSWERS AND HALVES
+# THE LIMIT ON FAILED REQUESTS OR WHEN THE MEDIAN LATENCY OF THE LAST 25 ANSWERS RISES ABOVE AI_LATENCY_TOLERANCE x
+# ITS LOWEST VALUE (SLOWLY DRIFTING UP). THE LIMIT STAYS BETWEEN AI_MIN_PARALLEL_REQUESTS AND AI_MAX_PARALLEL_REQUESTS.
+# FALSE KEEPS AI_PARALLEL_REQUESTS FIXED (DEFAULT UNTIL TUNED ON THE PRODUCTION SERVERS).
+AI_ADAPTIVE_CONCURRENCY = False
+AI_MIN_PARALLEL_REQUESTS = 1
+AI_MAX_PARALLEL_REQUESTS = 16
+AI_LATENCY_TOLERANCE = 2.0
+
+# RETRIES OF AI REQUESTS AFTER CONNECTION ERRORS, TIMEOUTS AND HTTP 5XX/429 ANSWERS, WITH JITTERED EXPONENTIAL BACKOFF
+# (RANDOM WAIT UP TO AI_RETRY_BASE_SECONDS x 2^ATTEMPT, AT MOST AI_RETRY_MAX_SECONDS).
+# ROWS THAT STILL FAIL ARE NOT WRITTEN AS "NOT FOUND", THEY ARE PROCESSED AGAIN BY THE NEXT RUN.
+AI_MAX_RETRIES = 3
+AI_RETRY_BASE_SECONDS = 1.0
+AI_RETRY_MAX_SECONDS = 30.0
+
+# STRUCTURED OUTPUT: THE MODEL ANSWERS WITH JSON {"year": 2011} / {"year": null} (response_format WITH JSON SCHEMA),
+# AT MOST AI_MAX_ANSWER_TOKENS TOKENS. FEWER GENERATED TOKENS MEAN FASTER ANSWERS. OTHER ANSWERS COUNT AS FAILED ROWS.
+# FALSE USES THE FREE TEXT ANSWER ('Year': 2011) WITH UP TO 150 TOKENS. ONLY FOR SINGLE ROW REQUESTS (AI_BATCH_SIZE 1).
+AI_STRUCTURED_OUTPUT = True
+AI_MAX_ANSWER_TOKENS = 16
+
+# PROMPT COMPRESSION: ONLY WORDS WITH DATE-LIKE NUMBERS (TWO OR FOUR+ DIGITS, Q1..Q4) AND AI_PROMPT_CONTEXT_WORDS WORDS
+# AROUND THEM ARE SENT, REPEATED FRAGMENTS AND THE FILENAME AT THE END ARE DROPPED. SHORTER PROMPTS ANSWER FASTER.
+# AI_PROMPT_COMPRESSION_CHECK_RATE OF THE ROWS ARE ASKED WITH THE FULL TEXT AS WELL, THE SHARE OF EQUAL ANSWERS IS LOGGED.
+AI_PROMPT_COMPRESSION = False
+AI_PROMPT_CONTEXT_WORDS = 1
+AI_PROMPT_COMPRESSION_CHECK_RATE = 0.02
+
+# TAIL LATENCY: A REQUEST WITHOUT ANSWER AFTER THE AI_HEDGE_PERCENTILE LATENCY OF THE LAST ANSWERS IS SENT A SECOND TIME,
+# THE FIRST ANSWER WINS AND THE OTHER REQUEST IS CANCELLED. THE DELAY STARTS WHEN THE REQUEST HAS ITS SLOT, A SECOND
+# REQUEST IS ONLY SENT WHILE A SLOT IS FREE AND FOR AT MOST AI_HEDGE_MAX_RATE OF THE REQUESTS. 0 DISABLES HEDGING.
+AI_HEDGE_PERCENTILE = 0
+AI_HEDGE_MAX_RATE = 0.05
+# MAXIMUM SECONDS FOR ONE REQUEST INCLUDING RETRIES AND HEDGING, THE ROW FAILS AFTERWARDS. 0 = NO DEADLINE.
+AI_ROW_DEADLINE_SECONDS = 180
+# MAXIMUM SECONDS OF THE AI STAGE OF ONE CHUNK. ROWS WITHOUT ANSWER AFTERWARDS ARE "PENDING": THE CHUNK IS WRITTEN
+# WITHOUT THEM AND THEY ARE ASKED AGAIN IN UP TO AI_PENDING_PASSES PASSES AT THE END OF THE RUN
+# (FAILED ROWS AS WELL). 0 = NO BUDGET.
+AI_CHUNK_BUDGET_SECONDS = 900
+AI_PENDING_PASSES = 1
+
+# NUMBER OF ROWS PACKED INTO ONE AI REQUEST. THE MODEL ANSWERS WITH AN INDEXED JSON LIST.
+# ROWS THE MODEL DROPS OR GARBLES ARE ASKED AGAIN ONE BY ONE. 1 DISABLES BATCHING.
+AI_BATCH_SIZE = 1
+
+# PERSISTENT CACHE FOR AI ANSWERS. RERUNS REUSE ANSWERS INSTEAD OF ASKING THE MODEL AGAIN.
+# THE CACHE KEY CONTAINS THE PROMPT TEMPLATE AND MODEL NAME, A CHANGED PROMPT IS NEVER SERVED OLD ANSWERS.
+# RUN "python ai_cache.py clear" TO DELETE ALL CACHED ANSWERS.
+ENABLE_AI_CACHE = True
+AI_CACHE_PATH = "tmp/ai_cache.sqlite"
+AI_CACHE_MAX_ENTRIES = 5000000
+AI_CACHE_MAX_AGE_DAYS = 180
+
+# DISTINCT TEXTS PER MODEL WHOSE AI ANSWERS ARE KEPT IN MEMORY DURING A RUN (LEAST RECENTLY USED ARE DROPPED).
+# REPEATS IN LATER CHUNKS ARE ANSWERED FROM MEMORY, OLDER ONES FROM THE AI CACHE. 0 KEEPS NOTHING.
+AI_RUN_MEMO_MAX_TEXTS = 100000
+
+# RUN METRICS: STAGE TIMINGS (transform, split, rules, ai, write), AI REQUEST LATENCY HISTOGRAM, REQUESTS IN FLIGHT,
+# TOKENS IN/OUT, RULE HITS PER DATE FORMAT FAMILY AND CACHE HIT RATES.
+# WRITTEN AFTER EVERY CHUNK TO METRICS_DIR AS JSON SUMMARY (ONE FILE PER RUN) AND AS PROMETHEUS TEXT FILE.
+ENABLE_METRICS = True
+METRICS_DIR = "logs"
+METRICS_PROMETHEUS_FILE = "metrics.prom"
+
+# STAGES RUN UNDER cProfile, E.G. ["rules", "ai"]. STATS ARE WRITTEN TO METRICS_DIR/profile_<stage>.prof,
+# VIEW THEM WITH "python -m pstats logs/profile_rules.prof". FOR SAMPLING: "py-spy record -o profile.svg -- python main.py"
+# ONLY ONE STAGE ENTRY IS PROFILED AT A TIME, IN PIPELINE_MODE OVERLAPPING ENTRIES ARE SKIPPED (profile_skipped_entries).
+# PROFILE A SINGLE STAGE OR SET PIPELINE_MODE = False FOR COMPLETE PROFILES.
+PROFILE_STAGES = []
+
 # CONSOLE COLORS
 GREEN = "\033[92m"
 RESET = "\033[0m"
@@ -1,9 +1,21 @@
 import os
+import re
+import csv
+import sys
+import heapq
 import shutil
+import tempfile
+import itertools
+import numpy as np
 import pandas as pd
 
 import glob
 import config
+from datetime import datetime
+from result_store import iter_result_rows
+
+# output files start with the time of their run: 20250101_120000_extracted_years_part_1.csv
+RESULT_TIMESTAMP_PATTERN = re.compile(r"^(\d{8}_\d{6})_")
 
 def split_csv_by_size(input_path, output_dir, max_rows=1000):
     """
@@ -40,97 +52,250 @@ def split_csv_by_size(input_path, output_dir, max_rows=1000):
 
 
 
-def concat_csv_files_in_new_df(input_folder_path):
-    input_files = glob.glob(f"{input_folder_path}/*.csv")
+def check_year(year_str, combined_str, origin, blacklist_years):
+    """
+    Year after verification: "0" for an AI year that is not trustworthy, otherwise the year unchanged.
+    Nur wenn origin ein AI-Ergebnis ist ("AI", "AI_SMALL", "AI_LARGE") wird das Jahr auf "0" gesetzt, wenn:
+    - 'combined' enthält "WE " + year
+    - ODER 'combined' enthält "WE " + die letzten 2 Ziffern von year, 4-stellig gepaddet
+    - ODER die letzten 2 Ziffern von year tauchen überhaupt nicht in combined auf
+    - ODER year in blacklist_years
+    """
+    # "AI", or the tier of the cascade ("AI_SMALL", "AI_LARGE")
+    if not str(origin).startswith("AI"):
+        return year_str
+
+    last_two = year_str[-2:]
+    padded_year = last_two.zfill(4)
+
+    # Bedingungen prüfen
+    if (f"WE {year_str}" in combined_str or
+        f"WE {padded_year}" in combined_str or
+        year_str in blacklist_years or
+        last_two not in combined_str):
+        return "0"
+    else:
+        return year_str
 
-    # Alle CSVs einlesen
-    dfs = [pd.read_csv(file) for file in input_files]
 
-    # Zusammenfügen
-    df = pd.concat(dfs, ignore_index=True)
+def verify_years(df, blacklist_years=None):
+    """
+    Vectorized check_year for a dataframe with the columns year, combined and origin.
+    Only rows with an AI origin ("AI", "AI_SMALL", "AI_LARGE") are checked.
+
+    Returns:
+        year column as strings, untrustworthy AI years set to "0"
+    """
+    if blacklist_years is None:
+        blacklist_years = set()
 
-    # Sortieren
-    df = df.sort_values("id")
+    years = df['year'].astype(str).to_numpy(dtype=object)
+    ai_rows = df['origin'].astype(str).str.startswith("AI").to_numpy()
+    if not ai_rows.any():
+        return pd.Series(years, index=df.index)
 
-    # Speichern
-    df.to_csv("dla_years.csv", index=False)
+    year_str = pd.Series(years[ai_rows], dtype=object)
+    combined_str = df['combined'].astype(str).to_numpy(dtype=object)[ai_rows]
+    last_two = year_str.str[-2:]
+    padded_year = last_two.str.zfill(4)
 
-    return df
+    # elementwise on object arrays: fixed width numpy strings would take rows x longest text x 4 bytes
+    def contains(patterns):
+        return np.fromiter((pattern in text for pattern, text in zip(patterns, combined_str)), dtype=bool,
+                           count=len(combined_str))
 
-def concat_csv_files_in_new_csv(input_folder_path, output_filepath):
-    df = concat_csv_files_in_new_df(input_folder_path)
-    df.to_csv(output_filepath, index=False)
+    # Bedingungen prüfen
+    rejected = (
+        contains("WE " + year_str)
+        | contains("WE " + padded_year)
+        | year_str.isin(blacklist_years).to_numpy()
+        | ~contains(last_two)
+    )
 
-    return output_filepath
+    years[ai_rows] = np.where(rejected, "0", year_str.to_numpy())
+    return pd.Series(years, index=df.index)
 
 
-def merge_csv_on_id(base_csv_path, additional_csv_path, column_to_add, output_csv_path):
+def result_file_timestamp(path):
     """
-    Merge two CSVs based on 'id' and append a single column from the second CSV to the first.
+    Timestamp (YYYYMMDD_HHMMSS) of a result file: its name prefix, the modification time for other files (journal).
+    """
+    match = RESULT_TIMESTAMP_PATTERN.match(os.path.basename(path))
+    if match:
+        return match.group(1)
+    return datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y%m%d_%H%M%S")
+
+
+def id_sort_key(value):
+    # numerisch wie pandas bei int IDs, sonst als Text dahinter
+    try:
+        return (0, int(value), "")
+    except ValueError:
+        return (1, 0, str(value))
 
-    Parameters:
-    - base_csv_path: Path to the main CSV file
-    - additional_csv_path: Path to the CSV file with additional data
-    - column_to_add: Name of the column in additional CSV to append
-    - output_csv_path: Path to save the merged CSV
+
+def external_sort(row_chunks, run_dir, memory_budget_bytes):
     """
-    # Haupt-CSV einlesen
-    df_base = pd.read_csv(base_csv_path)
+    Sorts rows (tuples of strings, first value id, last value a sequence number) by id and sequence number.
+    Rows are collected until memory_budget_bytes is reached, sorted and written as run files to run_dir.
+    The runs are merged lazily, so only one row per run is in memory while reading.
 
-    # Zusatz-CSV einlesen
-    df_add = pd.read_csv(additional_csv_path)
+    Returns:
+        Iterator over the sorted rows
+    """
+    def key(row):
+        return id_sort_key(row[0]) + (int(row[-1]),)
 
-    # Merge auf Basis der ID und nur die gewünschte Spalte hinzufügen
-    df_merged = df_base.merge(df_add[['id', column_to_add]], on="id", how="left")
+    runs = []
+    buffer = []
+    buffer_bytes = 0
 
-    # Ergebnis speichern
-    df_merged.to_csv(output_csv_path, index=False)
+    def write_run():
+        path = os.path.join(run_dir, f"run_{len(runs)}.csv")
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            csv.writer(f, lineterminator="\n").writerows(sorted(buffer, key=key))
+        runs.append(path)
 
-    return df_merged
+    for rows in row_chunks:
+        for row in rows:
+            buffer.append(row)
+            # grobe Schätzung des Speichers von Tupel und Strings
+            buffer_bytes += 64 + sum(sys.getsizeof(value) for value in row)
 
+        if buffer_bytes >= memory_budget_bytes:
+            write_run()
+            buffer = []
+            buffer_bytes = 0
 
-def verify_and_update_year(csv_path, output_path, blacklist_years=None):
-    """
-    Prüft die 'year'-Spalte und setzt sie ggf. auf "0", nur wenn origin == "AI":
-    - 'combined' enthält "WE " + year
-    - ODER 'combined' enthält "WE " + die letzten 2 Ziffern von year, 4-stellig gepaddet
-    - ODER die letzten 2 Ziffern von year tauchen überhaupt nicht in combined auf
-    - ODER year in blacklist_years
-    """
-    if blacklist_years is None:
-        blacklist_years = set()  # Standard: leer
+    # alles passt in den Speicher: keine Run-Dateien
+    if not runs:
+        return iter(sorted(buffer, key=key))
 
-    df = pd.read_csv(csv_path)
+    if buffer:
+        write_run()
+        buffer = []
 
-    def check_year(row):
-        if row['origin'] != "AI":
-            return str(row['year'])
+    def read_run(path):
+        with open(path, newline="", encoding="utf-8") as f:
+            yield from (tuple(row) for row in csv.reader(f))
 
-        year_str = str(row['year'])
-        combined_str = str(row['combined'])
-        last_two = year_str[-2:]
-        padded_year = last_two.zfill(4)
+    return heapq.merge(*(read_run(path) for path in runs), key=key)
 
-        # Bedingungen prüfen
-        if (f"WE {year_str}" in combined_str or
-            f"WE {padded_year}" in combined_str or
-            year_str in blacklist_years or
-            last_two not in combined_str):
-            return "0"
-        else:
-            return year_str
 
-    df['year'] = df.apply(check_year, axis=1)
+def generate_shipping_files_streaming(input_folder_path, extra_files, combined_source, raw_output_path,
+                                      verified_output_path, blacklist_years=None,
+                                      memory_budget_mb=config.SHIPPING_MEMORY_BUDGET_MB, chunksize=100000):
+    """
+    Merges the result files with the combined text and writes the raw and the verified shipping file, memory bounded.
 
-    # with or without col 'combined'
-    if not config.ADD_COMBINED_ROW and 'combined' in df.columns:
-        df_result = df.drop(columns=['combined'])
-    else:
-        df_result = df
+    Result rows (csv and parquet files of the output folder and extra_files like the result journal, newest file
+    first by result_file_timestamp; the first row per id wins, so the latest result of an id is shipped) and the
+    combined text are sorted externally by id, then merge-joined on id. The raw and the verified shipping file
+    are written in the same pass.
+    combined_source is the csv with id and combined (tmp/selected_combined_meta_cols.csv) or an iterable of
+    dataframes with these columns (stream_meta_chunks in STREAMING_MODE).
 
-    df_result.to_csv(output_path, index=False)
-    return df_result
+    Returns:
+        Number of rows written to each shipping file
+    """
+    if blacklist_years is None:
+        blacklist_years = set()
+
+    memory_budget_bytes = memory_budget_mb * 1024 * 1024
+    sequence = itertools.count()
+
+    def result_chunks():
+        files = (glob.glob(f"{input_folder_path}/*.csv") + glob.glob(f"{input_folder_path}/*.parquet")
+                 + list(extra_files or []))
+        # output of earlier runs stays in the output folder (CLEAN_OUTPUT_FOLDER_AT_STARTUP), newest first
+        for file in sorted(files, key=result_file_timestamp, reverse=True):
+            if file.endswith(".parquet"):
+                for rows in iter_result_rows([file], batch_size=chunksize):
+                    yield [row + (str(next(sequence)),) for row in rows]
+                continue
+
+            for chunk in pd.read_csv(file, dtype=str, keep_default_na=False, chunksize=chunksize):
+                yield [(row_id, year, origin, str(next(sequence)))
+                       for row_id, year, origin in zip(chunk['id'], chunk['year'], chunk['origin'])]
+
+    def combined_chunks():
+        if isinstance(combined_source, str):
+            chunks = pd.read_csv(combined_source, dtype=str, keep_default_na=False, chunksize=chunksize)
+        else:
+            chunks = (chunk.astype(str) for chunk in combined_source)
+        for chunk in chunks:
+            yield [(row_id, combined, str(next(sequence)))
+                   for row_id, combined in zip(chunk['id'], chunk['combined'])]
+
+    os.makedirs("tmp", exist_ok=True)
+    rows_written = 0
+
+    with tempfile.TemporaryDirectory(dir="tmp", prefix="shipping_sort_") as run_dir:
+        os.makedirs(os.path.join(run_dir, "results"))
+        os.makedirs(os.path.join(run_dir, "combined"))
+        results = external_sort(result_chunks(), os.path.join(run_dir, "results"), memory_budget_bytes // 2)
+        combined_rows = external_sort(combined_chunks(), os.path.join(run_dir, "combined"), memory_budget_bytes // 2)
+        # (id key, alle Texte dieser ID)
+        combined = ((key, [text for _, text, _ in group])
+                    for key, group in itertools.groupby(combined_rows, key=lambda row: id_sort_key(row[0])))
+
+        with open(raw_output_path, "w", newline="", encoding="utf-8") as raw_file, \
+                open(verified_output_path, "w", newline="", encoding="utf-8") as verified_file:
+            raw_writer = csv.writer(raw_file, lineterminator="\n")
+            verified_writer = csv.writer(verified_file, lineterminator="\n")
+            raw_writer.writerow(['id', 'year', 'origin', 'combined'])
+            verified_writer.writerow(['id', 'year', 'origin', 'combined'] if config.ADD_COMBINED_ROW else ['id', 'year', 'origin'])
+
+            combined_key, combined_texts = next(combined, (None, None))
+            previous_key = None
+
+            joined = []
+
+            def write_joined():
+                # raw rows unverändert, verified rows blockweise mit verify_years
+                block = pd.DataFrame(joined, columns=['id', 'year', 'origin', 'combined'])
+                block['verified'] = verify_years(block, blacklist_years)
+                raw_writer.writerows(joined)
+                verified_columns = ['id', 'verified', 'origin', 'combined'] if config.ADD_COMBINED_ROW else ['id', 'verified', 'origin']
+                verified_writer.writerows(block[verified_columns].itertuples(index=False, name=None))
+                joined.clear()
+
+            for row_id, year, origin, _ in results:
+                result_key = id_sort_key(row_id)
+                # gleiche ID aus späterer Quelle
+                if result_key == previous_key:
+                    continue
+                previous_key = result_key
+
+                # kombinierten Text bis zur ID vorspulen (left join)
+                while combined_key is not None and combined_key < result_key:
+                    combined_key, combined_texts = next(combined, (None, None))
+
+                for text in combined_texts if combined_key == result_key else [""]:
+                    joined.append((row_id, year, origin, text))
+                    rows_written += 1
+
+                if len(joined) >= chunksize:
+                    write_joined()
+
+            if joined:
+                write_joined()
+
+    return rows_written
 
 
 if __name__=="__main__":
-    print("no test")
+    # verify_years muss das gleiche Ergebnis wie check_year liefern
+    import random
+    rng = random.Random(5)
+    blacklist = {"1900", "2025", "2100"}
+    rows = []
+    for i in range(20000):
+        year = rng.choice(["2011", "2025", "1999", "0", "1900", "2003", ""])
+        combined = " ".join(rng.choice(["WE 2011", "WE 0011", "WE 0099", "_20110511", "99", "x", "WE 2003", ""])
+                            for _ in range(rng.randint(0, 4)))
+        rows.append((i, year, rng.choice(["AI", "AI_SMALL", "AI_LARGE", "RULE", None]), rng.choice([combined, None])))
+    test_df = pd.DataFrame(rows, columns=['id', 'year', 'origin', 'combined'])
+    expected = [check_year(str(y), str(c), o, blacklist) for y, c, o in zip(test_df['year'], test_df['combined'], test_df['origin'])]
+    result = verify_years(test_df, blacklist).tolist()
+    print(f"{'OK' if result == expected else 'ERROR'} verify_years equals check_year on {len(rows)} rows")
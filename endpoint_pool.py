@@ -0,0 +1,212 @@
+import time
+import asyncio
+import logging
+import aiohttp
+import config
+from collections import deque
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# latencies per endpoint kept for the percentile in the stats
+ENDPOINT_LATENCY_SAMPLES = 200
+
+
+class Endpoint:
+    """
+    One OpenAI compatible server: URL, model name, its own concurrency limit, health and latency stats.
+    """
+
+    def __init__(self, url, model=None, max_parallel=None, name=None):
+        self.url = url
+        self.model = model or config.AI_MODEL_NAME
+        self.max_parallel = max(1, max_parallel or config.AI_PARALLEL_REQUESTS)
+        self.name = name or urlsplit(url).netloc or url
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.latency_sum = 0.0
+        self.latencies = deque(maxlen=ENDPOINT_LATENCY_SAMPLES)
+
+    @property
+    def models_url(self):
+        # http://host:1234/v1/chat/completions -> http://host:1234/v1/models
+        base, _, _ = self.url.rpartition("/chat/completions")
+        return (base or self.url.rstrip("/")) + "/models"
+
+    def is_healthy(self, now=None):
+        return self.ejected_until <= (time.monotonic() if now is None else now)
+
+    def mean_latency(self):
+        answered = self.requests - self.failures
+        return self.latency_sum / answered if answered else None
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "url": self.url,
+            "model": self.model,
+            "healthy": self.is_healthy(),
+            "in_flight": self.in_flight,
+            "max_parallel": self.max_parallel,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "mean_seconds": self.mean_latency(),
+            "p95_seconds": latencies[int(len(latencies) * 0.95)] if latencies else None,
+        }
+
+
+class EndpointPool:
+    """
+    Routes every AI request to the healthy endpoint with the fewest requests in flight (relative to its limit).
+    An endpoint is ejected after AI_ENDPOINT_MAX_FAILURES failed requests in a row and re-admitted after
+    AI_ENDPOINT_EJECT_SECONDS or as soon as a health check succeeds. If all endpoints are ejected,
+    requests go to them anyway and fail fast instead of waiting.
+    """
+
+    def __init__(self, endpoints, max_failures=config.AI_ENDPOINT_MAX_FAILURES,
+                 eject_seconds=config.AI_ENDPOINT_EJECT_SECONDS):
+        if not endpoints:
+            raise ValueError("Endpoint pool without endpoints.")
+        self.endpoints = endpoints
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self._loop = None
+        self._condition = None
+
+    @classmethod
+    def from_config(cls, endpoints=None):
+        """
+        Pool of AI_ENDPOINTS (dicts with url and optional model, max_parallel, name), AI_API_URL if it is empty.
+        """
+        endpoints = endpoints if endpoints is not None else config.AI_ENDPOINTS
+        if not endpoints:
+            # a single server is limited by the (adaptive) limit of all requests only
+            endpoints = [{"url": config.AI_API_URL,
+                          "max_parallel": max(config.AI_PARALLEL_REQUESTS, config.AI_MAX_PARALLEL_REQUESTS)}]
+        return cls([Endpoint(**endpoint) for endpoint in endpoints])
+
+    @property
+    def max_parallel(self):
+        return sum(endpoint.max_parallel for endpoint in self.endpoints)
+
+    def condition(self):
+        # asyncio primitives belong to one event loop, a new asyncio.run() starts with a new one
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            for endpoint in self.endpoints:
+                endpoint.in_flight = 0
+        return self._condition
+
+    def pick(self):
+        """
+        Endpoint with a free slot and the fewest requests in flight, the faster one on a tie. None if all are busy.
+        """
+        now = time.monotonic()
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.is_healthy(now)]
+        # panic mode: all endpoints ejected, the one re-admitted next is tried
+        candidates = healthy or [min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)]
+        free = [endpoint for endpoint in candidates if endpoint.in_flight < endpoint.max_parallel]
+        if not free:
+            return None
+        return min(free, key=lambda endpoint: (endpoint.in_flight / endpoint.max_parallel, endpoint.mean_latency() or 0.0))
+
+    async def acquire(self):
+        condition = self.condition()
+        async with condition:
+            endpoint = None
+            while endpoint is None:
+                endpoint = self.pick()
+                if endpoint is None:
+                    await condition.wait()
+            endpoint.in_flight += 1
+            return endpoint
+
+    async def release(self, endpoint, latency, ok):
+        """
+        Frees the slot of a finished request and updates the stats and health of its endpoint (ok None: cancelled).
+        """
+        endpoint.in_flight -= 1
+        if ok is not None:
+            self.record(endpoint, latency, ok)
+
+        condition = self.condition()
+        async with condition:
+            condition.notify_all()
+
+    def record(self, endpoint, latency, ok):
+        endpoint.requests += 1
+        if ok:
+            endpoint.consecutive_failures = 0
+            endpoint.latency_sum += latency
+            endpoint.latencies.append(latency)
+            return
+
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures >= self.max_failures and endpoint.is_healthy():
+            self.eject(endpoint, f"{endpoint.consecutive_failures} failed requests in a row")
+
+    def eject(self, endpoint, reason):
+        endpoint.ejected_until = time.monotonic() + self.eject_seconds
+        endpoint.ejections += 1
+        logger.warning(f"AI endpoint {endpoint.name} ejected for {self.eject_seconds} seconds: {reason}.")
+
+    def readmit(self, endpoint):
+        endpoint.ejected_until = 0.0
+        endpoint.consecutive_failures = 0
+        logger.info(f"AI endpoint {endpoint.name} re-admitted.")
+
+    async def check_health(self, session, endpoint):
+        """
+        GET on the models endpoint of the server. True if it answers with HTTP 200.
+        """
+        try:
+            async with session.get(endpoint.models_url, timeout=config.AI_HEALTH_CHECK_TIMEOUT_SECONDS) as resp:
+                return resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def run_health_checks(self, session, interval=config.AI_HEALTH_CHECK_INTERVAL_SECONDS):
+        """
+        Checks all endpoints every interval seconds until cancelled: ejects failing ones, re-admits recovered ones.
+        """
+        while True:
+            results = await asyncio.gather(*(self.check_health(session, endpoint) for endpoint in self.endpoints))
+            for endpoint, healthy in zip(self.endpoints, results):
+                if healthy and not endpoint.is_healthy():
+                    self.readmit(endpoint)
+                elif not healthy and endpoint.is_healthy():
+                    self.eject(endpoint, "health check failed")
+            await asyncio.sleep(interval)
+
+    def stats(self) -> dict:
+        return {endpoint.name: endpoint.stats() for endpoint in self.endpoints}
+
+
+_pool = None
+
+
+def get_pool():
+    """
+    Returns the endpoint pool of this process.
+    """
+    global _pool
+    if _pool is None:
+        _pool = EndpointPool.from_config()
+    return _pool
+
+
+def set_endpoints(endpoints):
+    """
+    Replaces the pool, e.g. with the URL of a fake server (list of dicts like AI_ENDPOINTS).
+    """
+    global _pool
+    _pool = EndpointPool.from_config(endpoints)
+    return _pool
@@ -1,7 +1,10 @@
 import os
 import config
 from datetime import datetime
-from csv_file_operations import concat_csv_files_in_new_csv, merge_csv_on_id, verify_and_update_year
+from csv_file_operations import generate_shipping_files_streaming
+from result_journal import repair_journal
+from metrics import get_metrics
+from select_and_combine_metadata import stream_meta_chunks, get_meta_data_csv
 
 
 
@@ -10,24 +13,32 @@ def main():
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     os.makedirs(config.SHIPPING_DIR, exist_ok=True)
 
-    # BASEFILE: concat splitted files form output folder => compiled.csv
-    csv_base_file = os.path.join("tmp", "compiled_output_files.csv")
-    concat_csv_files_in_new_csv(config.OUTPUT_DIR, csv_base_file)
+    # RESULTS: output folder and the result journal
+    repair_journal(config.RESULT_JOURNAL_PATH)
+    extra_files = [config.RESULT_JOURNAL_PATH] if os.path.exists(config.RESULT_JOURNAL_PATH) else []
 
-    # ADDITIONAL FILE: get csv with combined value columns
+    # ADDITIONAL FILE: get csv with combined value columns. Streaming mode does not write it (an old one
+    # of an earlier part file run would be stale), the combined text is built from the meta data csv again.
     csv_add_file = os.path.join("tmp", "selected_combined_meta_cols.csv")
+    if config.STREAMING_MODE or not os.path.exists(csv_add_file):
+        combined_source = stream_meta_chunks(get_meta_data_csv(), 100000)
+    else:
+        combined_source = csv_add_file
 
-    # merge basefile with addtional file (pk is id column) => SHIPPING FILE WITHOUT CLEANUP
-    merged_file = os.path.join(config.SHIPPING_DIR, f"{timestamp}_{config.SHIPPING_FILENAME}_raw.csv")
-    df_merged = merge_csv_on_id(csv_base_file, csv_add_file, "combined", merged_file)
-    print(f"SHIPPING FILE 1: {merged_file} (raw results), {len(df_merged)}) rows")
-
-    # verify and cleanup shipping file
     # The AI is not 100% accurate; it recognizes some known years even though the data does not contain them.
-    blacklist_years = {"1900", "2025", "2027", "2029", "2031", "2032", "2033", "2037", "2039", "2040", "2093", "2100"}
+    # AI years are already validated during extraction (AI_MIN_CONFIDENCE), this also covers older result files.
+    blacklist_years = config.AI_YEAR_BLACKLIST
+
+    # merge results with addtional file (pk is id column) => SHIPPING FILE WITHOUT CLEANUP
+    # and verified shipping file in the same pass, sorted with at most SHIPPING_MEMORY_BUDGET_MB in memory
+    merged_file = os.path.join(config.SHIPPING_DIR, f"{timestamp}_{config.SHIPPING_FILENAME}_raw.csv")
     verfied_file = os.path.join(config.SHIPPING_DIR, f"{timestamp}_{config.SHIPPING_FILENAME}_verified.csv")
-    df_verified = verify_and_update_year(merged_file, verfied_file, blacklist_years=blacklist_years)
-    print(f"SHIPPING FILE 2: {verfied_file} (verified, recommended), {len(df_verified)}) rows")
+    with get_metrics().stage("shipping"):
+        rows = generate_shipping_files_streaming(config.OUTPUT_DIR, extra_files, combined_source, merged_file, verfied_file,
+                                                 blacklist_years=blacklist_years)
+    get_metrics().write()
+    print(f"SHIPPING FILE 1: {merged_file} (raw results), {rows}) rows")
+    print(f"SHIPPING FILE 2: {verfied_file} (verified, recommended), {rows}) rows")
 
 if __name__=="__main__":
   main()
\ No newline at end of file
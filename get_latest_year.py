@@ -1,12 +1,208 @@
 import re
+import random
+import calendar
 from datetime import datetime
 from typing import Optional
 
+import numpy as np
+import pandas as pd
+
+
+# Every supported format is built from digit runs with fixed lengths, so one pass over
+# the maximal digit runs of a string (plus the characters between them) finds all dates.
+DIGIT_RUN_PATTERN = re.compile(r'\d+')
+
+MONTH_TABLE = {f"{m:02d}": m for m in range(1, 13)}
+DAY_TABLE = {f"{d:02d}": d for d in range(1, 32)}
+QUARTER_DIGITS = "1234"
+CENTURY_PREFIXES = ("19", "20")
+
+# (month, day) pairs that exist in every year; Feb 29 is checked against LEAP_YEARS
+VALID_MONTH_DAYS = frozenset(
+    (month, day)
+    for month in range(1, 13)
+    for day in range(1, calendar.monthrange(2001, month)[1] + 1)
+)
+LEAP_YEARS = frozenset(year for year in range(1900, 2101) if calendar.isleap(year))
+
+# Digit runs the AI could read as a year: two digit years (Q2/11) and runs containing 1900..2100
+# (years, compact dates). Runs after "WE " are flat numbers, such AI years are rejected anyway (answer_confidence).
+YEAR_CANDIDATE_PATTERN = re.compile(r"(?<!\d)\d\d(?!\d)|(?<!\d)(?<!WE )\d*?(?:19\d\d|20\d\d|2100)")
+
+
+def parse_day(digits: str) -> int:
+    """
+    Same rule as the regex day group (0[1-9]|[12]\d|3[01]). Returns 0 if not a day.
+    """
+    day = DAY_TABLE.get(digits)
+    if day is not None:
+        return day
+    # [12]\d also accepts non-ASCII digits in the second position
+    if digits[0] in "12" and len(digits) == 2:
+        return int(digits)
+    return 0
+
+
+def is_valid_date(year: int, month: int, day: int) -> bool:
+    """
+    Table based replacement for datetime(year, month, day) on years 1900..2100.
+    """
+    if not 1900 <= year <= 2100:
+        return False
+    return (month, day) in VALID_MONTH_DAYS or (month == 2 and day == 29 and year in LEAP_YEARS)
+
 
 def extract_latest_year(text: str) -> Optional[str]:
     """
     Extracts the latest (most recent) year from a string based on reliable date formats.
 
+    Single pass engine: the string is tokenized into digit runs once and every run is
+    checked against all formats with table lookups. Returns exactly the same results as
+    extract_latest_year_reference(), which is kept as the readable specification.
+
+    Args:
+        text: Input string to search for dates
+
+    Returns:
+        The most recent year found as string, or "" if no valid dates found
+    """
+
+    if not text:
+        return ""
+
+    runs = [(match.start(), match.end(), match.group()) for match in DIGIT_RUN_PATTERN.finditer(text)]
+    if not runs:
+        return ""
+
+    text_length = len(text)
+    run_count = len(runs)
+    latest = 0
+
+    for index, (start, end, digits) in enumerate(runs):
+        size = end - start
+        sep = text[end] if end < text_length else ""
+        next_run = runs[index + 1] if index + 1 < run_count else None
+        # the following run is only part of the same date if exactly one separator is between them
+        if next_run is not None and next_run[0] != end + 1:
+            next_run = None
+
+        if size == 8:
+            # YYYYMMDD, DDMMYYYY, MMDDYYYY
+            if digits[:2] in CENTURY_PREFIXES:
+                month = MONTH_TABLE.get(digits[4:6])
+                day = parse_day(digits[6:8])
+                year = int(digits[:4])
+                if month and day and year > latest and is_valid_date(year, month, day):
+                    latest = year
+            if digits[4:6] in CENTURY_PREFIXES:
+                year = int(digits[4:])
+                if year > latest:
+                    day = parse_day(digits[:2])
+                    month = MONTH_TABLE.get(digits[2:4])
+                    if month and day and is_valid_date(year, month, day):
+                        latest = year
+                    month = MONTH_TABLE.get(digits[:2])
+                    day = parse_day(digits[2:4])
+                    if month and day and is_valid_date(year, month, day):
+                        latest = year
+
+        elif size == 4:
+            # ISO YYYY-MM-DD / YYYY/MM/DD (also covers datetime stamps)
+            if sep in ("-", "/") and next_run is not None and next_run[1] - next_run[0] == 2:
+                month = MONTH_TABLE.get(next_run[2])
+                third_run = runs[index + 2] if index + 2 < run_count else None
+                if (month and third_run is not None
+                        and third_run[0] == next_run[1] + 1
+                        and third_run[1] - third_run[0] == 2
+                        and text[next_run[1]] in "-/"):
+                    day = parse_day(third_run[2])
+                    year = int(digits)
+                    if day and year > latest and is_valid_date(year, month, day):
+                        latest = year
+
+            # 2024Q1
+            elif (sep in ("Q", "q") and digits[:2] in CENTURY_PREFIXES and next_run is not None
+                    and next_run[2] in QUARTER_DIGITS and next_run[1] - next_run[0] == 1):
+                latest = max(latest, int(digits))
+
+        elif size == 2:
+            # European DD.MM.YYYY
+            if sep == "." and next_run is not None and next_run[1] - next_run[0] == 2:
+                third_run = runs[index + 2] if index + 2 < run_count else None
+                if (third_run is not None
+                        and third_run[0] == next_run[1] + 1
+                        and third_run[1] - third_run[0] == 4
+                        and text[next_run[1]] == "."
+                        and third_run[2][:2] in CENTURY_PREFIXES):
+                    day = parse_day(digits)
+                    month = MONTH_TABLE.get(next_run[2])
+                    year = int(third_run[2])
+                    if day and month and year > latest and is_valid_date(year, month, day):
+                        latest = year
+
+        elif size == 1:
+            # Q1/25, Q2-2025, Q3 2024
+            if (digits in QUARTER_DIGITS and start > 0 and text[start - 1] in "Qq"
+                    and sep and (sep in "-/" or sep.isspace()) and next_run is not None):
+                year_digits = next_run[2]
+                year_size = next_run[1] - next_run[0]
+                if year_size == 2:
+                    latest = max(latest, 2000 + int(year_digits))
+                elif year_size == 4 and year_digits[:2] in CENTURY_PREFIXES:
+                    latest = max(latest, int(year_digits))
+
+    return str(latest) if latest else ""
+
+
+def extract_latest_years(texts) -> pd.Series:
+    """
+    Batch version of extract_latest_year() for a whole column.
+
+    The column is factorized first, so every distinct string is scanned only once and the
+    result is broadcast back with one take. Missing values give "".
+
+    Args:
+        texts: pandas Series or pyarrow string array
+
+    Returns:
+        "string" Series with the latest year per row, aligned to the input index
+    """
+
+    if not isinstance(texts, pd.Series):
+        texts = texts.to_pandas() if hasattr(texts, "to_pandas") else pd.Series(texts)
+
+    codes, uniques = pd.factorize(texts, use_na_sentinel=True)
+
+    # the extra "" at the end is picked by the NA code -1
+    years = np.array([extract_latest_year(text) for text in uniques] + [""], dtype=object)
+
+    return pd.Series(years[codes], index=texts.index, dtype="string")
+
+
+def has_year_candidate(text: str) -> bool:
+    """
+    True if the text contains a number that could plausibly be a year (YEAR_CANDIDATE_PATTERN).
+    Texts without such a number are not worth an AI request.
+    """
+    return bool(text) and YEAR_CANDIDATE_PATTERN.search(text) is not None
+
+
+def has_year_candidates(texts) -> pd.Series:
+    """
+    Batch version of has_year_candidate(), every distinct string is scanned once. Missing values give False.
+    """
+    if not isinstance(texts, pd.Series):
+        texts = pd.Series(texts)
+
+    codes, uniques = pd.factorize(texts, use_na_sentinel=True)
+    flags = np.array([has_year_candidate(text) for text in uniques] + [False], dtype=bool)
+    return pd.Series(flags[codes], index=texts.index)
+
+
+def extract_latest_year_reference(text: str) -> Optional[str]:
+    """
+    Extracts the latest (most recent) year from a string based on reliable date formats.
+
     Only considers:
     - ISO dates: YYYY-MM-DD, YYYY/MM/DD
     - European format: DD.MM.YYYY
@@ -16,6 +212,9 @@ def extract_latest_year(text: str) -> Optional[str]:
 
     Single year numbers (e.g., "2023") are ignored as they're unreliable.
 
+    Reference implementation with one regex scan per format. extract_latest_year() must
+    return identical results, see the equivalence check in __main__.
+
     Args:
         text: Input string to search for dates
 
@@ -176,6 +375,53 @@ if __name__ == "__main__":
     print("Testing extract_latest_year():\n")
     for text, expected in test_cases:
         result = extract_latest_year(text)
-        status = "OK" if result == expected else "ERROR"
+        reference = extract_latest_year_reference(text)
+        status = "OK" if result == expected == reference else "ERROR"
         print(f"{status} Input: '{text}'")
-        print(f"  Expected: {expected}, Got: {result}\n")
\ No newline at end of file
+        print(f"  Expected: {expected}, Got: {result}, Reference: {reference}\n")
+
+    # Equivalence check against the reference on a randomized corpus
+    rng = random.Random(42)
+    fragments = [
+        "2023-12-15", "2024/02/29", "2023-02-29", "1899-01-01", "2101-06-30", "0000-01-01",
+        "15.12.2023", "31.04.2022", "29.02.2000", "29.02.1900", "20231215", "15122023",
+        "12152023", "20230229", "20240229", "Q1/25", "q4-2024", "Q3 2023", "Q2\u00a099", "2024Q3",
+        "2023-11-26 14:30:00", "20231126_143000", "WE 1602", "7.4.1", "0511", "1975",
+        "Q5/25", "2024Q0", "\u0662\u0660\u0662\u0663-01-01", "1\u0663.01.2020", ".", "-", "/", "_",
+        " ", "T", "Q", "q", "pdf", "Gebäude", "\t",
+    ]
+
+    def random_text():
+        parts = []
+        for _ in range(rng.randint(0, 8)):
+            choice = rng.random()
+            if choice < 0.5:
+                parts.append(rng.choice(fragments))
+            elif choice < 0.8:
+                parts.append("".join(rng.choice("0123456789") for _ in range(rng.randint(1, 9))))
+            else:
+                parts.append(rng.choice(["", " ", "_", "-", "/", ".", "Q", "x"]))
+        return "".join(parts)
+
+    corpus = [random_text() for _ in range(50000)]
+    mismatches = [text for text in corpus if extract_latest_year(text) != extract_latest_year_reference(text)]
+    print(f"Randomized equivalence check: {len(corpus) - len(mismatches)}/{len(corpus)} identical")
+    for text in mismatches[:10]:
+        print(f"  ERROR Input: {text!r} Got: {extract_latest_year(text)}, Reference: {extract_latest_year_reference(text)}")
+
+    candidate_cases = [
+        ("Rights of Light - Basic Information.doc 373 WE 0047 5. Weitere Rechte und Ansprüche Dritter 5.2. Nachbarschaftsvereinbarungen WE", False),
+        ("1904_7.3_EG_0511.pdf 1900 WE 1904 7. Gebäude-, Grundstückszustand", True),
+        ("1602_7.4.1_Baubeschreibung WE 2011 7.4.1", False),
+        ("Mietvertrag 20110511 unterschrieben", True),
+        ("Protokoll Q2/11", True),
+        ("Plan 7.4.1 Nr. 373", False),
+        ("", False),
+    ]
+    for text, expected in candidate_cases:
+        status = "OK" if has_year_candidate(text) == expected else "ERROR"
+        print(f"{status} Candidate: {has_year_candidate(text)} Input: '{text}'")
+
+    batch = extract_latest_years(pd.Series(corpus + [None]))
+    batch_ok = batch.tolist() == [extract_latest_year_reference(text) for text in corpus] + [""]
+    print(f"Batch equivalence check: {'OK' if batch_ok else 'ERROR'}")
@@ -6,16 +6,21 @@ import time
 import pandas as pd
 import glob
 import re
-import aiohttp
 import asyncio
 
 from datetime import datetime
 from file_operation import move_file_to_directory, backup_files
 from console_prompt import ask_yes_no
-from select_and_combine_metadata import select_meta_cols
+from select_and_combine_metadata import select_meta_cols, stream_meta_chunks, get_meta_data_csv
 from logging_config import setup_logging
-from year_extracting import extracting_year_and_write_csv
+from year_extracting import extracting_year_and_write_csv, extract_rule_years, journal_rule_years, extract_ai_years
 from csv_file_operations import split_csv_by_size
+from ai_cache import get_cache
+from result_journal import get_journal, reset_journal
+from result_store import get_result_store
+from metrics import get_metrics
+from endpoint_pool import get_pool
+from prompt_lmstudio import create_session
 
 setup_logging(log_file="app.log")
 logger = logging.getLogger(__name__)
@@ -43,28 +48,25 @@ def cleanup_and_ensure_folder():
 
 
 def metafile_transformation():
-    # configure csv files
-    if config.TEST_MODE_ACTIVATED:
-        meta_data_csv = os.path.join("data", config.FILENAME_META_TST)
-    else:
-        meta_data_csv = os.path.join("data", config.FILENAME_META_PRD)
-
-    logger.info(f"Using data csv: {meta_data_csv}")
+    meta_data_csv = get_meta_data_csv()
 
     if ask_yes_no("Do you want to start a new meta file transformation? No, will use existing files."):
         shutil.rmtree("processed")
         os.makedirs("processed", exist_ok=True)
+        reset_journal()
 
         logger.info("Starting csv file transformation...")
         shutil.rmtree("csv_parts")
 
         #create new csv with 2 cols: id and combination of selected columns
-        tmpfile_path = select_meta_cols(meta_data_csv, create_csv=True)
+        with get_metrics().stage("transform"):
+            tmpfile_path = select_meta_cols(meta_data_csv, create_csv=True)
         logger.info(f"Successfully transformed meta file: {tmpfile_path}")
 
         # splitting big csv into chunk files
         logger.info(f"splitting meta file {tmpfile_path} in multiple files: max_rows {config.CSV_SPILT_FILE_ROWS}")
-        split_csv_by_size(tmpfile_path, "csv_parts", max_rows=config.CSV_SPILT_FILE_ROWS)
+        with get_metrics().stage("split"):
+            split_csv_by_size(tmpfile_path, "csv_parts", max_rows=config.CSV_SPILT_FILE_ROWS)
 
 
 
@@ -76,50 +78,348 @@ def natural_sort_key(filename):
     return int(match.group(1)) if match else 0
 
 
-async def main_async():
-    logger.info("Application started.")
-    cleanup_and_ensure_folder()
-    metafile_transformation()
+# end of the chunks in a pipeline queue
+PIPELINE_END = None
+
+
+def skip_done_rows(df, name_part):
+    """
+    Drops the IDs already in the result journal (e.g. before a crash).
+    """
+    journal = get_journal()
+    if journal is not None:
+        done = df['id'].astype(str).isin(journal.done_ids)
+        if done.any():
+            logger.info(f"Resume: {done.sum()} of {len(df)} rows of {name_part} already in result journal, skipped.")
+            df = df[~done].copy()
+    return df
+
+
+async def process_chunk(session, df, name_part):
+    """
+    Extracts the years of one chunk and writes its output csv. Returns the rows without result
+    (failed or pending AI requests). IDs already in the result journal (e.g. before a crash) are skipped.
+    """
+    df = skip_done_rows(df, name_part)
+    if df.empty:
+        return df
+
+    start_time = time.time()
+    #### PROCESSING START ###
+
+    df_years = await extracting_year_and_write_csv(session, df)
+    return await write_chunk(df, df_years, name_part, start_time)
+
+
+async def write_chunk(df, df_years, name_part, start_time):
+    """
+    Writes the results of a processed chunk (csv or parquet) and the metrics. Returns the rows of df without result.
+    """
+    chunk_rows = len(df)
+    open_rows = df.loc[~df['id'].astype(str).isin(df_years['id'].astype(str)), ['id', 'combined']]
+
+    metrics = get_metrics()
+    with metrics.stage("write"):
+        store = get_result_store()
+        if store is not None:
+            # append chunk as row group to the parquet file of this run
+            output_file_path = await asyncio.to_thread(store.append, df_years)
+            logger.info(f"Append {len(df_years)} rows to: {output_file_path}")
+        else:
+            #write output csv
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_file_name = f"{timestamp}_extracted_years_{name_part}.csv"
+            output_file_path = os.path.join(config.OUTPUT_DIR, output_file_name)
+
+            output_df = df_years.reindex(columns=['id', 'year', 'origin', 'confidence']).astype(str)
+            await asyncio.to_thread(output_df.to_csv, output_file_path, index=False)
+            logger.info(f"Write new file: {output_file_path}")
+
+    #### PROCESSING END ###
+    end_time = time.time()
+
+    elapsed = end_time - start_time
+    row_per_sec = round(chunk_rows / max(elapsed, 1e-9), 2)
+    logger.info(f"{name_part} processed in {elapsed:.2f} seconds. Rows per Sec: {row_per_sec} ")
+
+    metrics.count("rows", chunk_rows)
+    metrics.count("chunks")
+    if get_cache() is not None:
+        # one commit per chunk for the answers and lookups of the chunk
+        get_cache().flush()
+        get_cache().log_stats()
+        metrics.set_cache_stats(get_cache().hits, get_cache().misses)
+    metrics.set_endpoint_stats(get_pool().stats())
+
+    # written after every chunk, a crashed run still has its metrics
+    await asyncio.to_thread(metrics.write)
+
+    return open_rows
+
 
-    # sorted glob
-    csv_files = sorted(glob.glob(os.path.join("csv_parts", "part_*.csv")), key=natural_sort_key)
+async def process_part_files(session):
+    # the first pass processes all part files, further passes (AI_PENDING_PASSES) the files with open rows
+    for pass_number in range(config.AI_PENDING_PASSES + 1):
+        # sorted glob
+        csv_files = sorted(glob.glob(os.path.join("csv_parts", "part_*.csv")), key=natural_sort_key)
+        if pass_number:
+            if not csv_files:
+                break
+            logger.info(f"\n--- Pass {pass_number + 1}: {len(csv_files)} part files with pending rows ---")
+
+        if use_pipeline():
+            await run_pipeline(session, read_part_files(csv_files, pass_number))
+            continue
 
-    async with aiohttp.ClientSession() as session:
         for file_path in csv_files:
             filename = os.path.basename(file_path)
             if config.PROMPT_AFTER_CHUNK:
                 if not ask_yes_no(f"Do you want to process the next file ({filename})?"):
                     logger.warning("Aborted by user.")
-                    break
+                    return
 
 
             logger.info(f"\n--- Loading file {filename} ... ---")
             df = pd.read_csv(file_path)
-            chunk_rows = len(df)
 
+            open_rows = await process_chunk(session, df, part_name(file_path, pass_number))
+            finish_part_file(file_path, open_rows)
+
+
+def part_name(file_path, pass_number):
+    # own output file name per pass, the first one can have the same timestamp
+    return os.path.splitext(os.path.basename(file_path))[0] + (f"_pass{pass_number + 1}" if pass_number else "")
+
+
+def finish_part_file(file_path, open_rows):
+    # files with open rows stay in csv_parts, the next pass or run processes only these rows again (result journal)
+    if not open_rows.empty:
+        logger.warning(f"{len(open_rows)} rows of '{file_path}' without result, file stays in 'csv_parts'.")
+        return
+
+    move_file_to_directory(source_path=file_path, target_dir="processed")
+    logger.info(f"File moved from '{file_path}' to 'processed'")
+
+
+def read_part_files(csv_files, pass_number):
+    # (name_part, file_path, df) per part file for run_pipeline, next() runs in the reader thread
+    for file_path in csv_files:
+        logger.info(f"\n--- Loading file {os.path.basename(file_path)} ... ---")
+        yield part_name(file_path, pass_number), file_path, pd.read_csv(file_path)
+
+
+def use_pipeline():
+    # the pipeline reads ahead, it can not ask before each chunk
+    return config.PIPELINE_MODE and not config.PROMPT_AFTER_CHUNK
+
+
+async def run_pipeline(session, chunks, read_stage="read"):
+    """
+    Processes chunks with overlapping stages connected by bounded queues (PIPELINE_MODE):
+    reader (next chunk in a thread) -> rules (in a thread) -> AI (rows of all waiting chunks, up to
+    PIPELINE_AI_MAX_CHUNKS per call) -> writer. chunks yields (name_part, file_path, df), file_path is None
+    for chunks without part file. Part files without open rows are moved to 'processed'.
+    Returns the rows without result (failed or pending AI requests) of all chunks.
+    """
+    metrics = get_metrics()
+    rule_queue = asyncio.Queue(maxsize=config.PIPELINE_PREFETCH_CHUNKS)
+    ai_queue = asyncio.Queue(maxsize=config.PIPELINE_PREFETCH_CHUNKS)
+    write_queue = asyncio.Queue(maxsize=config.PIPELINE_PREFETCH_CHUNKS)
+    open_rows = []
+
+    async def reader():
+        while True:
+            with metrics.stage(read_stage):
+                chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            await rule_queue.put(chunk)
+        await rule_queue.put(PIPELINE_END)
+
+    async def rules():
+        while (chunk := await rule_queue.get()) is not PIPELINE_END:
+            name_part, file_path, df = chunk
+            logger.info(f"\n--- Processing chunk {name_part} ({len(df)} rows) ... ---")
+            df = skip_done_rows(df, name_part)
             start_time = time.time()
-            #### PROCESSING START ###
+            parts = None
+            if not df.empty:
+                parts = await asyncio.to_thread(extract_rule_years, df)
+                # the journal is written from the event loop only
+                journal_rule_years(*parts[:2])
+            await ai_queue.put((name_part, file_path, df, start_time, parts))
+        await ai_queue.put(PIPELINE_END)
+
+    async def ai_call(batch, slots):
+        try:
+            # first index level: position of the chunk in the batch, the results are split by it again
+            frames = {position: chunk[4][2] for position, chunk in enumerate(batch)
+                      if chunk[4] is not None and not chunk[4][2].empty}
+            answered = {}
+            if config.ENABLE_AI_PROCESS and frames:
+                if len(frames) > 1:
+                    logger.info(f"AI stage: {sum(len(frame) for frame in frames.values())} rows of {len(frames)} chunks "
+                                f"({', '.join(batch[position][0] for position in frames)}).")
+                df_ai = await extract_ai_years(session, pd.concat(frames))
+                answered = {position: rows.droplevel(0) for position, rows in df_ai.groupby(level=0)}
+
+            for position, (name_part, file_path, df, start_time, parts) in enumerate(batch):
+                df_years = None
+                if parts is not None:
+                    df_done, df_filtered, df_remaining = parts
+                    if config.ENABLE_AI_PROCESS and position in frames:
+                        # rows without answer are missing in df_ai
+                        df_remaining = answered.get(position, df_remaining.iloc[0:0])
+                    df_years = pd.concat([df_done, df_filtered, df_remaining], ignore_index=True).drop_duplicates()
+                await write_queue.put((name_part, file_path, df, start_time, df_years))
+        finally:
+            slots.release()
+
+    async def ai():
+        slots = asyncio.Semaphore(config.PIPELINE_AI_CONCURRENT_CALLS)
+        calls = set()
+        try:
+            end = False
+            while not end:
+                await slots.acquire()
+                for call in [call for call in calls if call.done()]:
+                    calls.discard(call)
+                    call.result()
+
+                # all chunks waiting when a call slot is free go into one call
+                batch = [await ai_queue.get()]
+                while len(batch) < config.PIPELINE_AI_MAX_CHUNKS and not ai_queue.empty():
+                    batch.append(ai_queue.get_nowait())
+                if batch[-1] is PIPELINE_END:
+                    end = True
+                    batch.pop()
+                if batch:
+                    calls.add(asyncio.ensure_future(ai_call(batch, slots)))
+                else:
+                    slots.release()
+            await asyncio.gather(*calls)
+        finally:
+            for call in calls:
+                call.cancel()
+        await write_queue.put(PIPELINE_END)
+
+    async def writer():
+        while (chunk := await write_queue.get()) is not PIPELINE_END:
+            name_part, file_path, df, start_time, df_years = chunk
+            chunk_open_rows = df if df_years is None else await write_chunk(df, df_years, name_part, start_time)
+            if file_path is not None:
+                finish_part_file(file_path, chunk_open_rows)
+            open_rows.append(chunk_open_rows)
+
+    stages = [asyncio.ensure_future(stage()) for stage in (reader, rules, ai, writer)]
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        for stage in stages:
+            stage.cancel()
+    return open_rows
+
+
+def resume_or_reset_journal():
+    """
+    Streaming mode has no meta file transformation: asks at startup whether the IDs of the result journal
+    (earlier or crashed run) are skipped or a new run starts with an empty journal.
+    """
+    journal = get_journal()
+    if journal is None or not journal.done_ids:
+        return
+
+    if ask_yes_no(f"Do you want to start a new run? No, will resume and skip the {len(journal.done_ids)} ids "
+                  f"in the result journal."):
+        reset_journal()
+    else:
+        logger.info(f"Resume: {len(journal.done_ids)} ids in result journal {journal.path} are skipped.")
 
-            df_years = await extracting_year_and_write_csv(session, df)
 
-            #write output csv
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            name_part = os.path.splitext(filename)[0]
-            output_file_name = f"{timestamp}_extracted_years_{name_part}.csv"
-            output_file_path = os.path.join(config.OUTPUT_DIR, output_file_name)
+async def process_stream(session):
+    # read, transform, extract and write chunk by chunk without intermediate files
+    resume_or_reset_journal()
+    chunksize = config.CSV_SPILT_FILE_ROWS or 1000
+    chunks = stream_meta_chunks(get_meta_data_csv(), chunksize)
+    part = 1
+    open_rows = []
 
-            await asyncio.to_thread(df_years[['id', 'year', 'origin']].astype(str).to_csv, output_file_path, index=False)
-            logger.info(f"Write new file: {output_file_path}")
+    if use_pipeline():
+        open_rows = await run_pipeline(session, ((f"stream_{number}", None, df) for number, df in enumerate(chunks, 1)),
+                                       read_stage="transform")
+    else:
+        while True:
+            # parsing the next chunk runs in a thread, so the event loop stays responsive
+            with get_metrics().stage("transform"):
+                df = await asyncio.to_thread(next, chunks, None)
+            if df is None:
+                break
+
+            name_part = f"stream_{part}"
+            if config.PROMPT_AFTER_CHUNK:
+                if not ask_yes_no(f"Do you want to process the next chunk ({name_part})?"):
+                    logger.warning("Aborted by user.")
+                    return
+
+            logger.info(f"\n--- Processing chunk {name_part} ({len(df)} rows) ... ---")
+            open_rows.append(await process_chunk(session, df, name_part))
+            part += 1
+
+    # rows without result (failed or pending AI requests) are asked again at the end
+    for pass_number in range(1, config.AI_PENDING_PASSES + 1):
+        pending = pd.concat(open_rows, ignore_index=True) if open_rows else pd.DataFrame()
+        if pending.empty:
+            break
+
+        logger.info(f"\n--- Pass {pass_number + 1}: {len(pending)} pending rows ---")
+        if use_pipeline():
+            open_rows = await run_pipeline(session, ((f"stream_pending{pass_number}_{start // chunksize + 1}", None,
+                                                      pending.iloc[start:start + chunksize].copy())
+                                                     for start in range(0, len(pending), chunksize)))
+            continue
 
-            #### PROCESSING END ###
-            end_time = time.time()
+        open_rows = []
+        for start in range(0, len(pending), chunksize):
+            open_rows.append(await process_chunk(session, pending.iloc[start:start + chunksize].copy(), f"stream_pending{pass_number}_{start // chunksize + 1}"))
 
-            elapsed = end_time - start_time
-            row_per_sec = round(elapsed / chunk_rows, 2)
-            logger.info(f"{file_path} processed in {elapsed:.2f} seconds. Rows per Sec: {row_per_sec} ")
+    remaining = sum(len(rows) for rows in open_rows)
+    if remaining:
+        logger.warning(f"{remaining} rows without result, they are processed again by the next run.")
 
-            move_file_to_directory(source_path=file_path, target_dir="processed")
-            logger.info(f"File moved from '{file_path}' to 'processed'")
+
+async def main_async():
+    logger.info("Application started.")
+    cleanup_and_ensure_folder()
+    # invalid result store settings fail before the first chunk
+    get_result_store()
+
+    async with create_session() as session:
+        health_checks = asyncio.ensure_future(get_pool().run_health_checks(session)) if config.ENABLE_AI_PROCESS else None
+        try:
+            if config.STREAMING_MODE:
+                await process_stream(session)
+            else:
+                metafile_transformation()
+                await process_part_files(session)
+        finally:
+            if health_checks is not None:
+                health_checks.cancel()
+                await asyncio.gather(health_checks, return_exceptions=True)
+
+    metrics = get_metrics()
+    metrics.set_endpoint_stats(get_pool().stats())
+    if get_cache() is not None:
+        metrics.set_cache_stats(get_cache().hits, get_cache().misses)
+        get_cache().close()
+
+    if get_journal() is not None:
+        get_journal().close()
+
+    if get_result_store() is not None:
+        get_result_store().close()
+
+    metrics.log_summary()
+    metrics.write()
 
     logger.info("All selected files are processed.")
 
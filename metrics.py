@@ -0,0 +1,286 @@
+import os
+import re
+import json
+import time
+import bisect
+import cProfile
+import logging
+import threading
+import config
+import pandas as pd
+
+from datetime import datetime
+from contextlib import contextmanager
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the AI request latency histogram
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# date format families of the rule based extraction, the first family containing the found year wins
+RULE_FAMILIES = {
+    "iso": r"(?<!\d){year}[-/]\d\d[-/]\d\d",
+    "european": r"\d\d\.\d\d\.{year}(?!\d)",
+    "compact": r"(?<!\d)(?:{year}\d{{4}}|\d{{4}}{year})(?!\d)",
+    "quarterly": r"[Qq][1-4][-/\s](?:{year}|{short})(?!\d)|(?<!\d){year}[Qq][1-4]",
+}
+
+
+def rule_family(text, year):
+    """
+    Date format family (see RULE_FAMILIES) that produced the rule based year of a text, "other" if unknown.
+    """
+    for family, pattern in RULE_FAMILIES.items():
+        if re.search(pattern.format(year=year, short=year[2:]), text):
+            return family
+    return "other"
+
+
+class RunMetrics:
+    """
+    Metrics of one run: stage timings, AI request latency, in-flight requests, tokens,
+    rule hits per date format family and cache hit rates.
+    Updated from the event loop and the rules thread (PIPELINE_MODE), all updates hold the lock.
+    """
+
+    def __init__(self):
+        self.started = datetime.now()
+        self.stage_seconds = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+        # entries of a stage running at the moment and since when at least one runs
+        self.stage_active = defaultdict(int)
+        self.stage_busy_since = {}
+        self.counters = defaultdict(int)
+        self.rule_families = defaultdict(int)
+        self.gauges = {}
+        self.endpoints = {}
+        self.model_latency = defaultdict(lambda: [0, 0.0])
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.profilers = {}
+        # stage whose entry runs under cProfile at the moment, only one at a time
+        self.profiling = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times a pipeline stage. Overlapping entries of the same stage (concurrent AI calls of the pipeline)
+        count the time while at least one of them runs, not the sum of all of them.
+        Stages listed in PROFILE_STAGES also run under cProfile, one entry at a time: a profiler hooks its thread
+        (process wide from Python 3.12), overlapping entries (PIPELINE_MODE) are not profiled but counted in
+        profile_skipped_entries.
+        """
+        with self._lock:
+            self.stage_active[name] += 1
+            if self.stage_active[name] == 1:
+                self.stage_busy_since[name] = time.perf_counter()
+
+        profiler = None
+        if name in config.PROFILE_STAGES:
+            with self._lock:
+                if self.profiling is None:
+                    self.profiling = name
+                    profiler = self.profilers.setdefault(name, cProfile.Profile())
+                else:
+                    self.counters["profile_skipped_entries"] += 1
+            # enabled and disabled on the thread of this entry
+            if profiler is not None:
+                profiler.enable()
+
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            with self._lock:
+                if profiler is not None:
+                    self.profiling = None
+                self.stage_active[name] -= 1
+                self.stage_calls[name] += 1
+                if self.stage_active[name] == 0:
+                    self.stage_seconds[name] += time.perf_counter() - self.stage_busy_since.pop(name)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def request_finished(self, seconds, usage=None, failed=False, model=None):
+        """
+        Records one AI request: latency (also per model), tokens of the completion usage field and failures.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            self.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.latency_sum += seconds
+            if model is not None:
+                self.model_latency[model][0] += 1
+                self.model_latency[model][1] += seconds
+            self.counters["ai_requests"] += 1
+            if failed:
+                self.counters["ai_requests_failed"] += 1
+            if usage:
+                self.counters["ai_tokens_in"] += usage.get("prompt_tokens") or 0
+                self.counters["ai_tokens_out"] += usage.get("completion_tokens") or 0
+
+    def request_cancelled(self):
+        with self._lock:
+            self.in_flight -= 1
+            self.counters["ai_requests_cancelled"] += 1
+
+    def add_rule_hits(self, texts, years):
+        """
+        Counts the rule based years per date format family (only with ENABLE_METRICS, one check per distinct text).
+        """
+        self.count("rule_rows", len(years))
+        hits = years != ""
+        self.count("rule_hits", int(hits.sum()))
+        if not config.ENABLE_METRICS or not hits.any():
+            return
+
+        pairs = pd.DataFrame({"text": texts[hits].astype(str), "year": years[hits].astype(str)})
+        families = defaultdict(int)
+        for (text, year), rows in pairs.value_counts(sort=False).items():
+            families[rule_family(text, year)] += int(rows)
+        with self._lock:
+            for family, rows in families.items():
+                self.rule_families[family] += rows
+
+    def set_cache_stats(self, hits, misses):
+        with self._lock:
+            self.counters["ai_cache_hits"] = hits
+            self.counters["ai_cache_misses"] = misses
+
+    def set_endpoint_stats(self, endpoints):
+        self.endpoints = endpoints
+
+    def summary(self) -> dict:
+        # copies, the rules stage can add entries from its thread (PIPELINE_MODE)
+        with self._lock:
+            stage_seconds, counters = dict(self.stage_seconds), defaultdict(int, self.counters)
+        requests = counters["ai_requests"]
+        rule_rows = counters["rule_rows"]
+        cache_lookups = counters["ai_cache_hits"] + counters["ai_cache_misses"]
+        return {
+            "started": self.started.isoformat(timespec="seconds"),
+            "elapsed_seconds": round((datetime.now() - self.started).total_seconds(), 3),
+            "stages": {name: {"seconds": round(seconds, 3), "calls": self.stage_calls[name]}
+                       for name, seconds in stage_seconds.items()},
+            "counters": counters,
+            "gauges": dict(self.gauges),
+            "rule_hit_ratio": counters["rule_hits"] / rule_rows if rule_rows else None,
+            "rule_families": dict(self.rule_families),
+            "ai_cache_hit_rate": counters["ai_cache_hits"] / cache_lookups if cache_lookups else None,
+            "ai_latency": {
+                "count": requests,
+                "mean_seconds": self.latency_sum / requests if requests else None,
+                "buckets": {str(bound): count for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), self.latency_buckets)},
+            },
+            "ai_in_flight": self.in_flight,
+            "ai_max_in_flight": self.max_in_flight,
+            "ai_endpoints": self.endpoints,
+            "ai_model_latency": {model: {"count": count, "mean_seconds": total / count}
+                                 for model, (count, total) in self.model_latency.items()},
+        }
+
+    def prometheus_text(self) -> str:
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP year_extract_{name} {help_text}")
+            lines.append(f"# TYPE year_extract_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"year_extract_{name}{labels} {value}")
+
+        metric("stage_seconds_total", "counter", "Seconds spent per pipeline stage.",
+               [(f'{{stage="{name}"}}', round(seconds, 6)) for name, seconds in dict(self.stage_seconds).items()])
+        metric("events_total", "counter", "Counters of the run.",
+               [(f'{{name="{name}"}}', value) for name, value in dict(self.counters).items()])
+        metric("rule_hits_total", "counter", "Rule based years per date format family.",
+               [(f'{{family="{family}"}}', rows) for family, rows in dict(self.rule_families).items()])
+        metric("gauge", "gauge", "Gauges of the run.", [(f'{{name="{name}"}}', value) for name, value in self.gauges.items()])
+        metric("ai_in_flight", "gauge", "AI requests in flight.", [("", self.in_flight)])
+        metric("ai_model_request_seconds_total", "counter", "Seconds of the AI requests per model.",
+               [(f'{{model="{model}"}}', round(total, 6)) for model, (count, total) in self.model_latency.items()])
+        metric("ai_model_requests_total", "counter", "AI requests per model.",
+               [(f'{{model="{model}"}}', count) for model, (count, total) in self.model_latency.items()])
+        metric("ai_endpoint_requests_total", "counter", "AI requests per endpoint.",
+               [(f'{{endpoint="{name}"}}', stats["requests"]) for name, stats in self.endpoints.items()])
+        metric("ai_endpoint_failures_total", "counter", "Failed AI requests per endpoint.",
+               [(f'{{endpoint="{name}"}}', stats["failures"]) for name, stats in self.endpoints.items()])
+        metric("ai_endpoint_healthy", "gauge", "1 if the endpoint is not ejected.",
+               [(f'{{endpoint="{name}"}}', int(stats["healthy"])) for name, stats in self.endpoints.items()])
+        metric("ai_endpoint_mean_seconds", "gauge", "Mean latency of the answered AI requests per endpoint.",
+               [(f'{{endpoint="{name}"}}', round(stats["mean_seconds"], 6))
+                for name, stats in self.endpoints.items() if stats["mean_seconds"] is not None])
+
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), self.latency_buckets):
+            cumulative += count
+            buckets.append((f'_bucket{{le="{bound}"}}', cumulative))
+        buckets += [("_sum", round(self.latency_sum, 6)), ("_count", cumulative)]
+        metric("ai_request_seconds", "histogram", "Latency of the AI requests.", buckets)
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """
+        Writes the JSON summary of this run and the Prometheus text file, and the cProfile stats of profiled stages.
+        """
+        if not config.ENABLE_METRICS:
+            return
+
+        os.makedirs(config.METRICS_DIR, exist_ok=True)
+        summary_path = os.path.join(config.METRICS_DIR, f"{self.started.strftime('%Y%m%d_%H%M%S')}_metrics.json")
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+
+        # written to a temp file first, a collector never reads a half written file
+        prometheus_path = os.path.join(config.METRICS_DIR, config.METRICS_PROMETHEUS_FILE)
+        with open(prometheus_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(prometheus_path + ".tmp", prometheus_path)
+
+        for name, profiler in self.profilers.items():
+            profiler.dump_stats(os.path.join(config.METRICS_DIR, f"profile_{name}.prof"))
+
+    def log_summary(self):
+        stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.stage_seconds.items())
+        logger.info(f"Stage timings: {stages}")
+
+        for name, stats in self.endpoints.items():
+            if stats["requests"]:
+                logger.info(f"AI endpoint {name}: {stats['requests']} requests, {stats['failures']} failed, "
+                            f"{stats['ejections']} ejections, mean {stats['mean_seconds'] or 0:.2f}s, p95 {stats['p95_seconds'] or 0:.2f}s.")
+
+        full, sent = self.counters["ai_prompt_chars_full"], self.counters["ai_prompt_chars_sent"]
+        if full:
+            checks = self.counters["ai_compression_checks"]
+            agree = f"{self.counters['ai_compression_agree']}/{checks} checked rows" if checks else "no rows checked"
+            # about 4 characters per token
+            logger.info(f"Prompt texts: ~{full // 4} tokens full, ~{sent // 4} tokens sent ({(1 - sent / full) * 100:.1f}% less), "
+                        f"same year with full text: {agree}.")
+
+
+_metrics = None
+
+
+def get_metrics():
+    """
+    Returns the metrics of this process. Metrics are always collected, ENABLE_METRICS controls the export.
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = RunMetrics()
+    return _metrics
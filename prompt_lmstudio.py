@@ -1,13 +1,97 @@
 import os
+import re
+import json
+import time
+import random
 import openai
 import aiohttp
 import asyncio
+import config
+from collections import deque
+from ai_cache import get_cache, make_key
+from metrics import get_metrics
+from adaptive_limiter import get_limiter
+from endpoint_pool import get_pool
 
 
-API_URL = "http://localhost:1234/v1/chat/completions"
 API_KEY = "no-key-required"   # LM Studio doesn’t need it
+# model name of the cache key, the endpoints of AI_ENDPOINTS can name their own model
+MODEL_NAME = config.AI_MODEL_NAME
 
-SEMAPHORE = asyncio.Semaphore(3)   # limit to 3 parallel API calls
+PROMPT_TEMPLATE_MISTRAL = (
+    "Suche nach möglichen Zeitstempeln und gibt nur dessen Jahreszahl (YYYY) aus, bei mehrfachtreffern das nur die jüngste jahreszahl ausgeben. Gültige Jahre sind nur zwischen 1900 und 2100. Antwortformat ist 'Year': {text}"
+)
+
+# retry for answers with low confidence (AI_RETRY_LOW_CONFIDENCE)
+PROMPT_TEMPLATE_STRICT = (
+    "Suche nur nach vollständigen Datumsangaben oder Zeitstempeln (z. B. 20110511, 11.05.2011, 2011-05-11, Q2/2011) und gib nur deren Jahreszahl (YYYY) aus, bei mehrfachtreffern nur die jüngste jahreszahl. "
+    "Nummern nach 'WE' sind Wohnungsnummern und keine Jahre. Wenn kein Datum sicher erkennbar ist, antworte 'Year': null. Antwortformat ist 'Year': {text}"
+)
+
+PROMPT_TEMPLATE_BATCH = (
+    "Suche in jedem der folgenden nummerierten Texte nach möglichen Zeitstempeln und gib nur dessen Jahreszahl (YYYY) aus, bei mehrfachtreffern nur die jüngste jahreszahl. Gültige Jahre sind nur zwischen 1900 und 2100. "
+    "Antworte ausschließlich mit einer JSON-Liste mit einem Eintrag pro Text im Format [{{\"i\": 0, \"year\": 2011}}, {{\"i\": 1, \"year\": null}}], year ist null wenn kein Jahr gefunden wurde.\n{texts}"
+)
+
+# structured output (AI_STRUCTURED_OUTPUT): the answer is a JSON object with one nullable integer year
+PROMPT_TEMPLATE_JSON = (
+    "Suche nach möglichen Zeitstempeln und gib nur dessen Jahreszahl (YYYY) aus, bei mehrfachtreffern nur die jüngste jahreszahl. Gültige Jahre sind nur zwischen 1900 und 2100. "
+    "Antworte nur mit {{\"year\": YYYY}} oder {{\"year\": null}}. Text: {text}"
+)
+
+PROMPT_TEMPLATE_JSON_STRICT = (
+    "Suche nur nach vollständigen Datumsangaben oder Zeitstempeln (z. B. 20110511, 11.05.2011, 2011-05-11, Q2/2011) und gib nur deren Jahreszahl (YYYY) aus, bei mehrfachtreffern nur die jüngste jahreszahl. "
+    "Nummern nach 'WE' sind Wohnungsnummern und keine Jahre. Wenn kein Datum sicher erkennbar ist, antworte {{\"year\": null}}. Antworte nur mit {{\"year\": YYYY}} oder {{\"year\": null}}. Text: {text}"
+)
+
+STRUCTURED_TEMPLATES = {PROMPT_TEMPLATE_MISTRAL: PROMPT_TEMPLATE_JSON, PROMPT_TEMPLATE_STRICT: PROMPT_TEMPLATE_JSON_STRICT}
+
+YEAR_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "year_answer",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"year": {"type": ["integer", "null"], "minimum": 1900, "maximum": 2100}},
+            "required": ["year"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+YEAR_JSON_PATTERN = re.compile(r'^\s*\{\s*"year"\s*:\s*(null|-?\d+)\s*\}\s*$')
+
+# fallback for answers that are no valid JSON: {"i": 3, "year": 2011} / {"i": 4, "year": null}
+BATCH_ITEM_PATTERN = re.compile(r'"?i"?\s*:\s*"?(\d+)"?\s*,\s*"?year"?\s*:\s*"?(\d{4}|null|None)"?')
+
+# words with a number that can be (part of) a date or year: two digits, four or more digits, quarters (Q2)
+DATE_WORD_PATTERN = re.compile(r"(?<!\d)(?:\d\d|\d{4,})(?!\d)|[Qq][1-4]")
+YEAR_IN_ANSWER_PATTERN = re.compile(r"\d{4}")
+
+# HTTP status codes worth another attempt: server overloaded or temporarily broken
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+# latencies of the last answered requests, for the hedging threshold (AI_HEDGE_PERCENTILE)
+RECENT_LATENCIES = deque(maxlen=500)
+HEDGE_MIN_SAMPLES = 20
+# hedgeable requests and hedges sent, for AI_HEDGE_MAX_RATE
+HEDGE_COUNTS = {"requests": 0, "hedged": 0}
+
+
+class RetryableError(Exception):
+    pass
+
+
+def hedge_delay():
+    """
+    Seconds after which a request is sent a second time, None while hedging is off or too few answers were seen.
+    """
+    if not config.AI_HEDGE_PERCENTILE or len(RECENT_LATENCIES) < HEDGE_MIN_SAMPLES:
+        return None
+    latencies = sorted(RECENT_LATENCIES)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * config.AI_HEDGE_PERCENTILE / 100))]
 
 def clean_for_csv(text):
     if not text:
@@ -34,29 +118,237 @@ def clean_for_csv(text):
 
     return text
 
+def compress_prompt_text(text, context_words=None):
+    """
+    Shorter prompt text: only the words with date-like numbers and context_words words around them,
+    repeated fragments and the filename echo at the end are dropped. Texts without such words stay unchanged.
+    """
+    if context_words is None:
+        context_words = config.AI_PROMPT_CONTEXT_WORDS
+
+    words = str(text).split()
+    # combined often ends with the filename again (without extension)
+    if len(words) > 1 and words[-1] in (words[0], os.path.splitext(words[0])[0]):
+        words = words[:-1]
+
+    # windows around the first occurrence of every date-like word, the Parent chain repeats them often
+    keep = [False] * len(words)
+    seen = set()
+    for index, word in enumerate(words):
+        if word not in seen and DATE_WORD_PATTERN.search(word):
+            seen.add(word)
+            for neighbour in range(max(0, index - context_words), min(len(words), index + context_words + 1)):
+                keep[neighbour] = True
+
+    fragments = []
+    fragment = []
+    for word, kept in zip(words + [""], keep + [False]):
+        if kept:
+            if not fragment or fragment[-1] != word:
+                fragment.append(word)
+        elif fragment:
+            fragments.append(" ".join(fragment))
+            fragment = []
+
+    if not fragments:
+        return text
+    return " ... ".join(dict.fromkeys(fragments))
+
+
+def prompt_text(text):
+    """
+    Text that is sent to the model (compressed with AI_PROMPT_COMPRESSION), counted for the metrics.
+    """
+    sent = compress_prompt_text(text) if config.AI_PROMPT_COMPRESSION else text
+    metrics = get_metrics()
+    metrics.count("ai_prompt_chars_full", len(str(text)))
+    metrics.count("ai_prompt_chars_sent", len(str(sent)))
+    return sent
+
+
+async def check_compression(session, text, template, compressed_raw, request_options):
+    """
+    Asks the model also with the full text and counts if both answers give the same year (AI_PROMPT_COMPRESSION_CHECK_RATE).
+    """
+    full_raw = await lmstudio_request(session, template.format(text=text), **request_options)
+    if str(full_raw).startswith("Error:"):
+        return
+
+    def year(raw):
+        match = YEAR_IN_ANSWER_PATTERN.search(str(raw))
+        return match.group() if match else None
+
+    metrics = get_metrics()
+    metrics.count("ai_compression_checks")
+    if year(full_raw) == year(compressed_raw):
+        metrics.count("ai_compression_agree")
+
+
+def create_session():
+    """
+    Client session for the AI requests: keep-alive connections, at most AI_CONNECTIONS_PER_HOST per server.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=config.AI_CONNECTIONS_PER_HOST * len(get_pool().endpoints),
+        limit_per_host=config.AI_CONNECTIONS_PER_HOST,
+        keepalive_timeout=config.AI_KEEPALIVE_SECONDS,
+        ttl_dns_cache=300,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
 # -----------------------------
 # Generic async request
 # -----------------------------
-async def lmstudio_request(session: aiohttp.ClientSession, question: str, model="dein-modell-name"):
+async def lmstudio_request(session: aiohttp.ClientSession, question: str, model=None, max_tokens=150,
+                           response_format=None):
     """
-    Sends a prompt to the LM Studio API asynchronously.
+    Sends a prompt to the LM Studio API asynchronously. Failed requests and requests
+    over AI_ROW_DEADLINE_SECONDS return "Error: ...".
+    Without model the model name of the chosen endpoint is used.
     """
 
     payload = {
-        "model": model,
         "messages": [{"role": "user", "content": question}],
         "temperature": 0.1,
-        "max_tokens": 150
+        "max_tokens": max_tokens
     }
+    if model is not None:
+        payload["model"] = model
+    if response_format is not None:
+        payload["response_format"] = response_format
 
-    async with SEMAPHORE:   # only 3 requests at a time
-        try:
-            async with session.post(API_URL, json=payload, timeout=60) as resp:
-                data = await resp.json()
-                return data["choices"][0]["message"]["content"]
+    try:
+        if config.AI_ROW_DEADLINE_SECONDS:
+            return await asyncio.wait_for(request_with_retries(session, payload), config.AI_ROW_DEADLINE_SECONDS)
+        return await request_with_retries(session, payload)
+    except asyncio.TimeoutError:
+        get_metrics().count("ai_deadline_exceeded")
+        return f"Error: deadline of {config.AI_ROW_DEADLINE_SECONDS} seconds exceeded"
+
+
+async def request_with_retries(session, payload):
+    """
+    Retries connection errors, timeouts and HTTP 429/5xx with jittered exponential backoff.
+    """
+    error = None
+    for attempt in range(config.AI_MAX_RETRIES + 1):
+        if attempt:
+            # full jitter, retries of parallel requests do not hit the server at the same moment
+            await asyncio.sleep(random.uniform(0, min(config.AI_RETRY_MAX_SECONDS, config.AI_RETRY_BASE_SECONDS * 2 ** attempt)))
+            get_metrics().count("ai_request_retries")
 
+        try:
+            return await hedged_request(session, payload)
+        except (RetryableError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            error = e
         except Exception as e:
-            return f"Error: {e}"
+            # malformed answers or client errors fail the same way on every attempt
+            error = e
+            break
+
+    return f"Error: {type(error).__name__} {error}"
+
+
+async def hedged_request(session, payload):
+    """
+    Sends the request a second time if there is no answer hedge_delay() after it was sent, the first answer wins.
+    Only hedges while a slot is free and at most AI_HEDGE_MAX_RATE of the requests.
+    """
+    sent = asyncio.Event()
+    primary = asyncio.ensure_future(post_completion(session, payload, sent))
+    delay = hedge_delay()
+    if delay is None:
+        return await primary
+
+    HEDGE_COUNTS["requests"] += 1
+    pending = {primary}
+    try:
+        # time waiting for a slot is no tail latency of the server, the delay starts when the request is sent
+        sent_wait = asyncio.ensure_future(sent.wait())
+        try:
+            await asyncio.wait({primary, sent_wait}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            sent_wait.cancel()
+
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if done or not may_hedge():
+            return await primary
+
+        HEDGE_COUNTS["hedged"] += 1
+        get_metrics().count("ai_hedged_requests")
+        pending.add(asyncio.ensure_future(post_completion(session, payload)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        # both failed
+        return primary.result()
+    finally:
+        # the slower request (or both, if the row is cancelled) stops here
+        for task in pending:
+            task.cancel()
+
+
+def may_hedge():
+    """
+    True if a second request neither waits for a slot nor pushes the hedged share above AI_HEDGE_MAX_RATE.
+    """
+    limiter = get_limiter()
+    if limiter.in_flight >= int(limiter.limit) or get_pool().pick() is None:
+        return False
+    return HEDGE_COUNTS["hedged"] < HEDGE_COUNTS["requests"] * config.AI_HEDGE_MAX_RATE
+
+
+async def post_completion(session, payload, sent=None):
+    """
+    One request to the chat completions endpoint of the least busy server, within the adaptive concurrency limit.
+    sent (asyncio.Event) is set as soon as the request has its slot.
+    """
+    limiter = get_limiter()
+    pool = get_pool()
+    metrics = get_metrics()
+
+    await limiter.acquire()
+    try:
+        endpoint = await pool.acquire()
+    except BaseException:
+        await limiter.release(0.0, None)
+        raise
+    if sent is not None:
+        sent.set()
+
+    metrics.request_started()
+    start = time.perf_counter()
+    ok = False
+    if "model" not in payload:
+        payload = {**payload, "model": endpoint.model}
+    try:
+        async with session.post(endpoint.url, json=payload, timeout=config.AI_REQUEST_TIMEOUT_SECONDS) as resp:
+            if resp.status in RETRY_STATUS_CODES:
+                raise RetryableError(f"HTTP {resp.status}")
+            data = await resp.json()
+            answer = data["choices"][0]["message"]["content"]
+            ok = True
+            latency = time.perf_counter() - start
+            RECENT_LATENCIES.append(latency)
+            metrics.request_finished(latency, data.get("usage"), model=payload["model"])
+            return answer
+
+    except asyncio.CancelledError:
+        # the other request of a hedged pair was faster, no signal for the concurrency limit
+        ok = None
+        raise
+    finally:
+        latency = time.perf_counter() - start
+        if ok is None:
+            metrics.request_cancelled()
+        elif not ok:
+            metrics.request_finished(latency, failed=True, model=payload["model"])
+        await pool.release(endpoint, latency, ok)
+        await limiter.release(latency, ok)
+        metrics.set_gauge("ai_concurrency_limit", int(limiter.limit))
 
 
 # -----------------------------
@@ -69,11 +361,39 @@ async def send_prompt(session, question: str):
 # -----------------------------
 # Specific wrapper: extract_company
 # -----------------------------
-async def set_prompt_text(session, text: str):
+def parse_year_answer(raw):
+    """
+    Year of a structured answer ({"year": 2011} or {"year": null}) as "YYYY" or "null".
+    A well-formed answer with a year out of range ({"year": 11}, {"year": 1850}) is "null", not found.
+    None if the answer does not have this form (no JSON, cut off).
+    """
+    match = YEAR_JSON_PATTERN.match(str(raw))
+    if match is None:
+        return None
 
-    question_mistral = (
-        f"Suche nach möglichen Zeitstempeln und gibt nur dessen Jahreszahl (YYYY) aus, bei mehrfachtreffern das nur die jüngste jahreszahl ausgeben. Gültige Jahre sind nur zwischen 1900 und 2100. Antwortformat ist 'Year': {text}"
-    )
+    year = match.group(1)
+    if year == "null":
+        return year
+    return year if len(year) == 4 and 1900 <= int(year) <= 2100 else "null"
+
+
+async def set_prompt_text(session, text: str, template=PROMPT_TEMPLATE_MISTRAL, model=None):
+    """
+    Year answer for one text. model overrides the model of the endpoints (cascade, AI_SMALL_MODEL_NAME).
+    """
+    sent_text = prompt_text(text)
+    if config.AI_STRUCTURED_OUTPUT:
+        template = STRUCTURED_TEMPLATES.get(template, template)
+
+    # answers of earlier runs, texts with the same prompt share the answer
+    cache = get_cache()
+    if cache is not None:
+        cache_key = make_key(sent_text, template, model or MODEL_NAME)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    question_mistral = template.format(text=sent_text)
 
 
     # question_openai = (
@@ -100,15 +420,117 @@ async def set_prompt_text(session, text: str):
 
 
 
-    raw = await lmstudio_request(session, question_mistral)
-    return clean_for_csv(raw)
+    request_options = {"model": model}
+    if config.AI_STRUCTURED_OUTPUT:
+        request_options.update(max_tokens=config.AI_MAX_ANSWER_TOKENS, response_format=YEAR_RESPONSE_FORMAT)
+        raw = await lmstudio_request(session, question_mistral, **request_options)
+        answer = parse_year_answer(raw)
+        if answer is None and not str(raw).startswith("Error:"):
+            # the schema was not enforced (cut off answer, server without structured output support):
+            # a failed row, not cached and asked again, a guess from free text would be shipped as a year
+            get_metrics().count("ai_unstructured_answers")
+            raw = f"Error: unstructured answer {clean_for_csv(raw)[:80]!r}"
+        if answer is None:
+            answer = raw
+    else:
+        raw = await lmstudio_request(session, question_mistral, **request_options)
+        answer = clean_for_csv(raw)
+
+    # some rows are asked with the full text as well, to compare the answers
+    if (sent_text != text and not str(raw).startswith("Error:")
+            and random.random() < config.AI_PROMPT_COMPRESSION_CHECK_RATE):
+        await check_compression(session, text, template, raw, request_options)
+
+    # failed requests are not cached, they are asked again on the next run
+    if cache is not None and not str(raw).startswith("Error:"):
+        cache.put(cache_key, answer, template, model or MODEL_NAME)
+
+    return answer
+
+
+def parse_batch_answer(raw, count):
+    """
+    Reads the indexed answer of a batch prompt. Returns {index: answer} only for entries
+    with a valid index and a year or null, dropped or garbled entries are missing.
+    """
+    raw = str(raw)
+    answers = {}
+
+    def add(index, year):
+        try:
+            index = int(index)
+        except (TypeError, ValueError):
+            return
+        if not 0 <= index < count or index in answers:
+            return
+
+        if year is None or str(year) in ("null", "None"):
+            answers[index] = "null"
+        elif re.fullmatch(r"\d{4}", str(year)):
+            answers[index] = str(year)
+
+    items = None
+    start, end = raw.find("["), raw.rfind("]")
+    if start != -1 and end > start:
+        try:
+            items = json.loads(raw[start:end + 1])
+        except ValueError:
+            items = None
+
+    if isinstance(items, list):
+        for item in items:
+            if isinstance(item, dict):
+                add(item.get("i"), item.get("year"))
+    else:
+        for match in BATCH_ITEM_PATTERN.finditer(raw):
+            add(match.group(1), match.group(2))
+
+    return answers
+
+
+# -----------------------------
+# Specific wrapper: batch of texts
+# -----------------------------
+async def set_prompt_texts_batch(session, texts: list, model=None):
+    """
+    Sends several texts in one request and returns one answer per text.
+    Texts missing in the model answer are asked again with set_prompt_text.
+    """
+    answers = [None] * len(texts)
+    sent_texts = [prompt_text(text) for text in texts]
+    cache_model = model or MODEL_NAME
+
+    # answers of earlier runs
+    cache = get_cache()
+    if cache is not None:
+        for idx, text in enumerate(sent_texts):
+            answers[idx] = cache.get(make_key(text, PROMPT_TEMPLATE_BATCH, cache_model))
+
+    open_idx = [idx for idx, answer in enumerate(answers) if answer is None]
+    if len(open_idx) > 1:
+        numbered = "\n".join(f"{i}: {clean_for_csv(sent_texts[idx])}" for i, idx in enumerate(open_idx))
+        question = PROMPT_TEMPLATE_BATCH.format(texts=numbered)
+        raw = await lmstudio_request(session, question, model=model, max_tokens=20 * len(open_idx) + 50)
+
+        for i, answer in parse_batch_answer(raw, len(open_idx)).items():
+            idx = open_idx[i]
+            answers[idx] = answer
+            if cache is not None:
+                cache.put(make_key(sent_texts[idx], PROMPT_TEMPLATE_BATCH, cache_model), answer, PROMPT_TEMPLATE_BATCH, cache_model)
+
+    # single row fallback for dropped or garbled entries
+    for idx, answer in enumerate(answers):
+        if answer is None:
+            answers[idx] = await set_prompt_text(session, texts[idx], model=model)
+
+    return answers
 
 
 # -----------------------------
 # MAIN
 # -----------------------------
 async def main():
-    async with aiohttp.ClientSession() as session:
+    async with create_session() as session:
 
         # print("Sending test prompt...")
         # answer1 = await send_prompt(session, "Wie heisst die Landeshauptstadt von Hessen?")
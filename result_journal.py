@@ -0,0 +1,129 @@
+import os
+import csv
+import time
+import logging
+import config
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_COLUMNS = ["id", "year", "origin", "confidence"]
+
+
+class ResultJournal:
+    """
+    Append-only csv journal of (id, year, origin, confidence) results, flushed to disk regularly.
+    IDs in the journal are done and are skipped by the next run.
+    """
+
+    def __init__(self, path=config.RESULT_JOURNAL_PATH, flush_rows=config.RESULT_JOURNAL_FLUSH_ROWS,
+                 flush_seconds=config.RESULT_JOURNAL_FLUSH_SECONDS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        rotate_outdated_journal(path)
+        repair_journal(path)
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.done_ids = load_done_ids(path)
+
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "a", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file, lineterminator="\n")
+        if is_new:
+            self.writer.writerow(JOURNAL_COLUMNS)
+
+        self.unflushed = 0
+        self.last_flush = time.time()
+        logger.info(f"Result journal {path}: {len(self.done_ids)} ids already done.")
+
+    def write_rows(self, rows):
+        """
+        Appends (id, year, origin, confidence) rows.
+        """
+        for row_id, year, origin, confidence in rows:
+            self.writer.writerow([row_id, year, origin, confidence])
+            self.done_ids.add(str(row_id))
+            self.unflushed += 1
+
+        if self.unflushed >= self.flush_rows or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unflushed = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def load_done_ids(path) -> set:
+    """
+    Reads the ids of a journal.
+    """
+    if not os.path.exists(path):
+        return set()
+
+    with open(path, newline="", encoding="utf-8") as f:
+        return {row[0] for row in csv.reader(f) if len(row) == len(JOURNAL_COLUMNS) and row[0] != "id"}
+
+
+def rotate_outdated_journal(path):
+    """
+    A journal with other columns (older version) is renamed to *.old and a new journal is started.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+
+    with open(path, newline="", encoding="utf-8") as f:
+        header = next(csv.reader(f), [])
+
+    if header != JOURNAL_COLUMNS:
+        os.replace(path, path + ".old")
+        logger.warning(f"Result journal {path} has columns {header}, moved to {path}.old and started new.")
+
+
+def repair_journal(path=config.RESULT_JOURNAL_PATH):
+    """
+    Cuts off a torn last line of a crashed run, so the journal only contains complete rows.
+    """
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        tail_start = max(0, size - 65536)  # a journal row is far shorter than that
+        f.seek(tail_start)
+        tail = f.read()
+        if tail and not tail.endswith(b"\n"):
+            f.truncate(tail_start + tail.rfind(b"\n") + 1)
+            logger.warning(f"Result journal {path}: incomplete last line removed.")
+
+
+_journal = None
+
+
+def get_journal():
+    """
+    Returns the shared journal of this process, or None if ENABLE_RESULT_JOURNAL is off.
+    """
+    global _journal
+    if not config.ENABLE_RESULT_JOURNAL:
+        return None
+    if _journal is None:
+        _journal = ResultJournal()
+    return _journal
+
+
+def reset_journal():
+    """
+    Starts a new journal, e.g. for a new meta file transformation.
+    """
+    global _journal
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+    if os.path.exists(config.RESULT_JOURNAL_PATH):
+        os.remove(config.RESULT_JOURNAL_PATH)
+        logger.info(f"Result journal {config.RESULT_JOURNAL_PATH} removed.")
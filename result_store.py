@@ -0,0 +1,133 @@
+import os
+import glob
+import logging
+import pandas as pd
+import config
+
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def result_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("id", pa.int64()),
+        ("year", pa.uint16()),
+        ("origin", pa.dictionary(pa.int8(), pa.string())),
+        ("confidence", pa.float32()),
+    ])
+
+
+def to_result_table(df):
+    """
+    Typed arrow table of a result dataframe: integer id, uint16 year (null if empty), categorical origin,
+    float confidence (null if unknown).
+    """
+    import pyarrow as pa
+
+    origin = df['origin'] if 'origin' in df.columns else pd.Series("", index=df.index)
+    confidence = df['confidence'] if 'confidence' in df.columns else pd.Series(None, index=df.index, dtype=float)
+    typed = pd.DataFrame({
+        "id": pd.to_numeric(df['id']).astype("int64"),
+        "year": pd.to_numeric(df['year'], errors="coerce").astype("UInt16"),
+        "origin": origin.astype(str).astype("category"),
+        "confidence": pd.to_numeric(confidence, errors="coerce").astype("float32"),
+    })
+    return pa.Table.from_pandas(typed, schema=result_schema(), preserve_index=False)
+
+
+class ParquetResultStore:
+    """
+    Writes all chunks of one run as row groups into a single parquet file in the output folder.
+    The file is complete when close() has written the footer, rows of a crashed run are in the result journal.
+    """
+
+    def __init__(self, output_dir=config.OUTPUT_DIR):
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.path = os.path.join(output_dir, f"{timestamp}_extracted_years.parquet")
+        self.writer = None
+        self.rows = 0
+
+    def append(self, df):
+        import pyarrow.parquet as pq
+
+        table = to_result_table(df)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, result_schema())
+
+        # one row group per chunk
+        self.writer.write_table(table, row_group_size=max(1, table.num_rows))
+        self.rows += table.num_rows
+        return self.path
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            logger.info(f"Result store {self.path}: {self.rows} rows written.")
+
+
+def read_results(files=None, columns=None):
+    """
+    Reads parquet result files (default: all in the output folder) into one dataframe,
+    only with the requested columns. Files without footer (crashed run) are skipped.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if files is None:
+        files = sorted(glob.glob(os.path.join(config.OUTPUT_DIR, "*.parquet")))
+
+    tables = []
+    for file in files:
+        try:
+            tables.append(pq.read_table(file, columns=columns))
+        except (OSError, pa.ArrowInvalid) as e:
+            logger.warning(f"Result store: skipping unreadable file {file}: {e}")
+
+    if not tables:
+        return pd.DataFrame(columns=columns or result_schema().names)
+
+    return pa.concat_tables(tables, promote_options="permissive").to_pandas()
+
+
+def iter_result_rows(files, batch_size=100000):
+    """
+    Streams (id, year, origin) string tuples from parquet result files, batch by batch.
+    Files without footer (crashed run) are skipped.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    for file in files:
+        try:
+            parquet_file = pq.ParquetFile(file)
+        except (OSError, pa.ArrowInvalid) as e:
+            logger.warning(f"Result store: skipping unreadable file {file}: {e}")
+            continue
+
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=['id', 'year', 'origin']):
+            columns = batch.to_pydict()
+            yield [
+                (str(row_id), "" if year is None else str(year), origin or "")
+                for row_id, year, origin in zip(columns['id'], columns['year'], columns['origin'])
+            ]
+
+
+_store = None
+
+
+def get_result_store():
+    """
+    Returns the parquet store of this run, or None if RESULT_STORE_FORMAT is "csv".
+    """
+    global _store
+    if config.RESULT_STORE_FORMAT != "parquet":
+        return None
+    if not config.ENABLE_RESULT_JOURNAL:
+        # the file has no footer until close(), the chunks of a crashed run are only in the journal
+        raise ValueError('RESULT_STORE_FORMAT "parquet" needs ENABLE_RESULT_JOURNAL = True.')
+    if _store is None:
+        _store = ParquetResultStore()
+    return _store
@@ -1,3 +1,6 @@
+import os
+import re
+import random
 import pandas as pd
 import logging
 import config
@@ -5,20 +8,60 @@ import config
 
 logger = logging.getLogger(__name__)
 
-def select_meta_cols(input_path, output_path='tmp//selected_combined_meta_cols.csv', create_csv:bool = False):
+# Reinigung in der gleichen Reihenfolge wie combine_meta_cols_reference. nan / None und
+# Tabs + Quotes sind ein Durchlauf, weil sich ihre Treffer nie beeinflussen.
+CLEAN_ID_PATTERN = re.compile(r'\(\d+\)\s*')
+CLEAN_NAN_TAB_QUOTE_PATTERN = re.compile(r'\b(?:nan|NaN|None)\b|[\t"]+')
+
+# Standard na_values von pandas.read_csv: der pyarrow-Reader liest diese Zellen ebenfalls als leer
+PANDAS_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+def combine_meta_cols(meta_df):
     '''
-    Erstelle eine neues Dataframe aus CSV mit Metadaten, dabei werden nur notwendige Spalten uebernommen:
-    id, parent, Parent1, Parent2,.., Parent13
-    :param input_path:
-    :param [optional] output_path:
-    :param create_csv:
-    :return: path to new csv file (with prepared data)
+    Reduziert ein Dataframe mit Metadaten auf die Spalten id und combined.
+    combined ist die bereinigte Verbindung von filename, parent, Parent2,.., Parent13.
+    Liefert byteweise das gleiche Ergebnis wie combine_meta_cols_reference, aber ohne Zeilenschleife.
+    :param meta_df: Dataframe (dtype str) wie aus der Metadaten CSV gelesen
+    :return: Dataframe mit id und combined
     '''
+    parent_cols = [col for col in meta_df.columns if "Parent" in col and col != "Parent1"]
+
+    # Wähle die Spalten aus
+    cols_to_clean = ['filename', 'parent'] + parent_cols
+
+    # alle Spalten untereinander, jeder unterschiedliche Wert wird nur einmal gereinigt
+    values = meta_df[cols_to_clean].astype(str).to_numpy().ravel(order="F")
+    codes, uniques = pd.factorize(values)
+    cleaned_uniques = (
+        pd.Series(uniques, dtype=object)
+        .str.replace(CLEAN_ID_PATTERN, '', regex=True)  # (12345)
+        .str.replace(CLEAN_NAN_TAB_QUOTE_PATTERN, '', regex=True)  # nan / None, Tabs + Quotes
+        .str.replace(r'\s+', ' ', regex=True)  # doppelte Leerzeichen
+        .str.strip()  # trim
+        .to_numpy()
+    )
+    cleaned = cleaned_uniques[codes].reshape(len(cols_to_clean), len(meta_df))
+
+    logger.info("Combining columns after id column.")
+    # bereinigte Werte enthalten nur einzelne Leerzeichen, leere Spalten ergeben doppelte Leerzeichen
+    joined = pd.Series(cleaned[0], index=meta_df.index, dtype=object)
+    for column_values in cleaned[1:]:
+        joined = joined + " " + column_values
 
-    logger.info(f"select_meta_cols: Reading csv {input_path} ...")
-    meta_df = pd.read_csv(input_path, sep=';', dtype=str)
-    input_rows = len(meta_df)
+    combined_df = meta_df[['id']].copy()
+    combined_df['combined'] = joined.str.replace(r' {2,}', ' ', regex=True).str.strip()
 
+    return combined_df
+
+
+def combine_meta_cols_reference(meta_df):
+    '''
+    Referenz fuer combine_meta_cols (zeilenweise, fuenf Regex-Durchlaeufe je Spalte).
+    Wird nur noch fuer den Vergleich im __main__ Block verwendet.
+    :param meta_df: Dataframe (dtype str) wie aus der Metadaten CSV gelesen
+    :return: Dataframe mit id und combined
+    '''
     parent_cols = [col for col in meta_df.columns if "Parent" in col and col != "Parent1"]
 
     # Wähle die Spalten aus
@@ -39,7 +82,6 @@ def select_meta_cols(input_path, output_path='tmp//selected_combined_meta_cols.c
         )
     )
 
-    logger.info("Combining columns after id column.")
     # Combine alle Spalten außer 'id' sauber
     new_df['combined'] = new_df[cols_to_clean].apply(
         lambda row: ' '.join([x for x in row if x.strip() != ""]), axis=1
@@ -49,18 +91,120 @@ def select_meta_cols(input_path, output_path='tmp//selected_combined_meta_cols.c
     first_col = new_df.columns[0]
     combined_df = new_df[[first_col, "combined"]]
 
+    return combined_df
+
+
+def resolve_meta_cols(input_path):
+    '''
+    Liest nur die Kopfzeile der CSV mit Metadaten und bestimmt die benötigten Spalten:
+    id, filename, parent, Parent2,.., Parent13 (ohne Parent1). Alle anderen Spalten werden nicht gelesen.
+    :param input_path:
+    :return: Liste der Spaltennamen in Dateireihenfolge
+    '''
+    header = pd.read_csv(input_path, sep=';', dtype=str, nrows=0).columns
+    return [col for col in header if col in ('id', 'filename', 'parent') or ("Parent" in col and col != "Parent1")]
+
+
+def read_meta_chunks(input_path, chunksize):
+    '''
+    Liest die CSV mit Metadaten in Chunks und nur mit den benötigten Spalten (siehe resolve_meta_cols).
+    :param input_path:
+    :param chunksize: Anzahl Zeilen je Chunk
+    :return: Generator mit Dataframes (dtype str)
+    '''
+    usecols = resolve_meta_cols(input_path)
+
+    if config.META_CSV_ENGINE == "pyarrow":
+        # pandas unterstützt chunksize nicht mit engine="pyarrow", daher direkt der Streaming-Reader von pyarrow
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+
+        reader = pa_csv.open_csv(
+            input_path,
+            read_options=pa_csv.ReadOptions(block_size=16 << 20),
+            parse_options=pa_csv.ParseOptions(delimiter=';'),
+            convert_options=pa_csv.ConvertOptions(include_columns=usecols,
+                                                  column_types={col: pa.string() for col in usecols},
+                                                  strings_can_be_null=True, null_values=PANDAS_NA_VALUES),
+        )
+        buffered = []
+        buffered_rows = 0
+        for batch in reader:
+            buffered.append(batch)
+            buffered_rows += batch.num_rows
+            while buffered_rows >= chunksize:
+                table = pa.Table.from_batches(buffered)
+                yield table.slice(0, chunksize).to_pandas()
+                rest = table.slice(chunksize)
+                buffered = rest.to_batches()
+                buffered_rows = rest.num_rows
+        if buffered_rows:
+            yield pa.Table.from_batches(buffered).to_pandas()
+        return
+
+    yield from pd.read_csv(input_path, sep=';', dtype=str, usecols=usecols, chunksize=chunksize)
+
+
+def get_meta_data_csv():
+    # configure csv files
+    if config.TEST_MODE_ACTIVATED:
+        meta_data_csv = os.path.join("data", config.FILENAME_META_TST)
+    else:
+        meta_data_csv = os.path.join("data", config.FILENAME_META_PRD)
+
+    logger.info(f"Using data csv: {meta_data_csv}")
+    return meta_data_csv
+
+
+def stream_meta_chunks(input_path, chunksize):
+    '''
+    Liest die CSV mit Metadaten in Chunks und liefert je Chunk das Dataframe mit id und combined.
+    Es ist immer nur ein Chunk im Speicher, es werden keine Zwischendateien geschrieben.
+    :param input_path:
+    :param chunksize: Anzahl Zeilen je Chunk
+    :return: Generator mit Dataframes (id, combined)
+    '''
+    logger.info(f"stream_meta_chunks: Reading csv {input_path} in chunks of {chunksize} rows ...")
+    for meta_df in read_meta_chunks(input_path, chunksize):
+        yield combine_meta_cols(meta_df)
+
+
+def select_meta_cols(input_path, output_path='tmp//selected_combined_meta_cols.csv', create_csv:bool = False):
+    '''
+    Erstelle eine neues Dataframe aus CSV mit Metadaten, dabei werden nur notwendige Spalten uebernommen:
+    id, parent, Parent1, Parent2,.., Parent13
+    :param input_path:
+    :param [optional] output_path:
+    :param create_csv:
+    :return: path to new csv file (with prepared data)
+    '''
+
+    logger.info(f"select_meta_cols: Reading csv {input_path} in chunks of {config.META_READ_CHUNK_ROWS} rows ...")
+    input_rows = 0
+    output_rows = 0
+    part = -1
+
+    for part, meta_df in enumerate(read_meta_chunks(input_path, config.META_READ_CHUNK_ROWS)):
+        input_rows += len(meta_df)
+        combined_df = combine_meta_cols(meta_df)
+        output_rows += len(combined_df)
+
+        #create csv it activated, chunk by chunk
+        if create_csv:
+            combined_df.to_csv(output_path, index=False, escapechar='\\', quoting=None,
+                               mode='w' if part == 0 else 'a', header=part == 0)
+
+    # no data rows: csv with header only
+    if create_csv and part == -1:
+        pd.DataFrame(columns=['id', 'combined']).to_csv(output_path, index=False)
+
     #output
-    output_rows = len(combined_df)
     # compare amount of rows
     if input_rows == output_rows:
         logger.info(f"OK: Amount of output rows ({output_rows}) in = amount input rows ({input_rows})")
     else:
         logger.warning(f"Warning: Amount of output rows ({output_rows}) not equal to input rows ({input_rows})!")
 
-    #create csv it activated
-    if create_csv:
-        combined_df.to_csv(output_path, index=False, escapechar='\\', quoting=None)
-
     return output_path
 
 
@@ -68,5 +212,41 @@ def select_meta_cols(input_path, output_path='tmp//selected_combined_meta_cols.c
 if __name__ == "__main__":
     input_file = "data//dla_short_test.csv"
 
-    df = select_meta_cols(input_file, create_csv=True)
-    print(f"Successfully transformed file")
\ No newline at end of file
+    if os.path.exists(input_file):
+        df = select_meta_cols(input_file, create_csv=True)
+        print(f"Successfully transformed file")
+    else:
+        # without the sample export a generated corpus of the same layout is compared
+        from benchmarks.generate_corpus import ensure_corpus
+        print(f"{input_file} not found, using a generated corpus.")
+        input_file = ensure_corpus(20000)
+
+    # byteweiser Vergleich mit der Referenz: Beispieldatei und zufällige Problemfälle
+    rng = random.Random(7)
+    pieces = ["nan", "NaN", "None", "(12345)", "(1)", " ", "  ", "\t", '"', "x", "Bau", "7.4.", "WE 1602",
+              "20110511", "\u00a0", "Nonex", "(ab)", "(", ")", "_", "-"]
+    columns = ["id", "filename", "parent", "Parent1"] + [f"Parent{i}" for i in range(2, 14)]
+    random_df = pd.DataFrame(
+        [[str(i)] + [None if rng.random() < 0.3 else "".join(rng.choice(pieces) for _ in range(rng.randint(0, 6)))
+                     for _ in columns[1:]] for i in range(20000)],
+        columns=columns,
+    )
+    for name, sample_df in [(input_file, pd.read_csv(input_file, sep=';', dtype=str)), ("random", random_df)]:
+        new_bytes = combine_meta_cols(sample_df).to_csv(index=False, escapechar='\\', quoting=None).encode("utf-8")
+        ref_bytes = combine_meta_cols_reference(sample_df).to_csv(index=False, escapechar='\\', quoting=None).encode("utf-8")
+        print(f"{'OK' if new_bytes == ref_bytes else 'ERROR'} byte-for-byte equal to reference: {name}")
+
+    # beide CSV-Engines müssen das gleiche combined liefern, auch bei NA-Zellen (NA, N/A, NULL, ...)
+    import tempfile
+    na_rows = [";".join([str(i)] + [rng.choice(PANDAS_NA_VALUES + ["a.pdf", "Bau 2011", "NAx", "n/a."])
+                                    for _ in columns[1:]]) for i in range(2000)]
+    engine_bytes = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        na_file = os.path.join(tmp_dir, "na_values.csv")
+        with open(na_file, "w", encoding="utf-8") as f:
+            f.write("\n".join([";".join(columns)] + na_rows) + "\n")
+        for engine in ("c", "pyarrow"):
+            config.META_CSV_ENGINE = engine
+            engine_bytes[engine] = b"".join(chunk.to_csv(index=False, escapechar='\\', quoting=None).encode("utf-8")
+                                            for chunk in stream_meta_chunks(na_file, 500))
+    print(f"{'OK' if engine_bytes['c'] == engine_bytes['pyarrow'] else 'ERROR'} c and pyarrow engine equal with NA cells")
\ No newline at end of file
@@ -1,16 +1,26 @@
 import pandas as pd
 import re
 import os
+import time
 import asyncio
 import logging
 import aiohttp
 import config
 
-from prompt_lmstudio import set_prompt_text
-from get_latest_year import extract_latest_year
+from collections import OrderedDict
+from prompt_lmstudio import set_prompt_text, set_prompt_texts_batch, PROMPT_TEMPLATE_MISTRAL, PROMPT_TEMPLATE_STRICT
+from get_latest_year import extract_latest_years, has_year_candidates
+from result_journal import get_journal
+from metrics import get_metrics
+from adaptive_limiter import get_limiter
 
 logger = logging.getLogger(__name__)
 
+# AI answers of this run, keyed by model (None: model of the endpoints) and combined text, the
+# AI_RUN_MEMO_MAX_TEXTS most recently used per model. Duplicates in later chunk files are answered
+# from here instead of asking the model again, older repeats are found in the AI cache.
+RUN_AI_ANSWERS = {}
+
 def is_valid_year(year):
     try:
         y = int(year)
@@ -18,49 +28,338 @@ def is_valid_year(year):
     except (TypeError, ValueError):
         return False
 
-# ASYNCHRON VERSION
-async def extracting_year_and_write_csv(session, df):
+
+def answer_to_year(answer):
+    """
+    Year (YYYY) of an AI answer: first 4-digit number, NOT_FOUND_RETURN_VALUE if there is none,
+    "0" if it is no valid year.
+    """
+    answer = str(answer)  # falls None oder andere Typen
+    # structured answers are already validated years or "null" (parse_year_answer)
+    if len(answer) == 4 and answer.isdigit():
+        return answer if is_valid_year(answer) else "0"
+
+    match = re.search(r"\d{4}", answer)
+    year = match.group() if match else config.NOT_FOUND_RETURN_VALUE
+    return year if is_valid_year(year) else "0"
+
+
+def answer_confidence(year, text, blacklist_years=None):
+    """
+    Confidence of an AI year for its text, between 0 and 1 (see AI_MIN_CONFIDENCE in config).
+    Uses the same rules as check_year in the shipping generation.
+    """
+    if blacklist_years is None:
+        blacklist_years = config.AI_YEAR_BLACKLIST
+
+    if not is_valid_year(year) or year in blacklist_years:
+        return 0.0
+
+    text = str(text)
+    last_two = year[-2:]
+    if f"WE {year}" in text or f"WE {last_two.zfill(4)}" in text:
+        return 0.0
+    if year in text:
+        return 1.0
+    if last_two in text:
+        return 0.6
+    return 0.2
+
+
+def validate_answer(answer, text):
+    """
+    (year, confidence) of an AI answer.
+    """
+    year = answer_to_year(answer)
+    return year, answer_confidence(year, text)
+
+
+def accepted_year(year, confidence):
+    return year if confidence >= config.AI_MIN_CONFIDENCE else "0"
+
+
+def needs_retry(year, confidence):
+    return config.AI_RETRY_LOW_CONFIDENCE and is_valid_year(year) and confidence < config.AI_MIN_CONFIDENCE
+
+
+def is_failed_answer(answer):
+    # failed requests return "" (exception) or "Error: ..." (lmstudio_request)
+    return not answer or answer.startswith("Error:")
+
+
+async def ask_ai_for_years(session, texts, on_answer=None, template=PROMPT_TEMPLATE_MISTRAL, batch_size=None, model=None):
+    """
+    Sends all texts to the AI with a pool of workers (as many as the concurrency limit can grow to),
+    AI_BATCH_SIZE texts per request. model overrides the model of the endpoints.
+    Answers are returned in input order. A failing batch is logged and its rows return "".
+    on_answer(idx, answer) is called as soon as an answer arrives.
+    Rows still open after AI_CHUNK_BUDGET_SECONDS are cancelled and return "" (pending).
+    """
+    total = len(texts)
+    answers = [""] * total
+    batch_size = max(1, config.AI_BATCH_SIZE if batch_size is None else batch_size)
+    queue = asyncio.Queue()
+    for start in range(0, total, batch_size):
+        queue.put_nowait((start, texts[start:start + batch_size]))
+
+    processed = 0
+    logged = 0
+    start_time = time.time()
+
+    async def worker():
+        nonlocal processed, logged
+        while not queue.empty():
+            start, batch = queue.get_nowait()
+            try:
+                if len(batch) == 1:
+                    answers[start] = await set_prompt_text(session, batch[0], template, model=model)
+                else:
+                    answers[start:start + len(batch)] = await set_prompt_texts_batch(session, batch, model=model)
+            except Exception as e:
+                logger.warning(f"AI request for rows {start}-{start + len(batch) - 1} failed: {e}")
+
+            if on_answer is not None:
+                for idx in range(start, start + len(batch)):
+                    on_answer(idx, answers[idx])
+
+            processed += len(batch)
+            # Fortschritt ausgeben mit flush
+            if processed - logged >= 10 or processed == total:
+                logged = processed
+                logger.info(f"Processed by AI: {processed}/{total} rows ({processed / total * 100:.1f}%)")
+
+    # the limiter decides how many of the workers have a request in flight
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(get_limiter().maximum, queue.qsize()))]
+    done, running = await asyncio.wait(workers, timeout=config.AI_CHUNK_BUDGET_SECONDS or None) if workers else (set(), set())
+    if running:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        pending = total - processed
+        get_metrics().count("ai_pending_rows", pending)
+        logger.warning(f"AI time budget of {config.AI_CHUNK_BUDGET_SECONDS} seconds exceeded: {pending} rows pending.")
+    for task in done:
+        task.result()
+
+    if total:
+        elapsed = time.time() - start_time
+        logger.info(f"AI throughput: {total} rows in {elapsed:.2f} seconds ({total / max(elapsed, 1e-9):.2f} rows/sec, "
+                    f"batch size {batch_size}, {int(get_limiter().limit)} parallel requests).")
+    return answers
+
+
+async def ask_ai_for_unique_texts(session, texts, on_answer=None, model=None):
+    """
+    Asks the AI once per distinct text that was not answered earlier in this run
+    and broadcasts the answers back to all rows. on_answer(text, answer) is called once per distinct text.
+    """
+    run_answers = RUN_AI_ANSWERS.setdefault(model, OrderedDict())
+    unique_texts = list(dict.fromkeys(texts))
+    new_texts = [text for text in unique_texts if text not in run_answers]
+    # answers used by this chunk are read below, they are not evicted before
+    known = {text: run_answers[text] for text in unique_texts if text in run_answers}
+    for text in known:
+        run_answers.move_to_end(text)
+
+    saved = len(texts) - len(new_texts)
+    saved_pct = saved / len(texts) * 100 if texts else 0.0
+    get_metrics().count("ai_dedup_saved", saved)
+    logger.info(f"AI dedup: {len(texts)} rows, {len(unique_texts)} unique texts, {len(new_texts)} new in this run "
+                f"({saved} requests saved, {saved_pct:.1f}%).")
+
+    if on_answer is not None:
+        for text, answer in known.items():
+            on_answer(text, answer)
+
+    new_answer = None if on_answer is None else lambda idx, answer: on_answer(new_texts[idx], answer)
+    answers = dict(zip(new_texts, await ask_ai_for_years(session, new_texts, on_answer=new_answer, model=model)))
+
+    # failed requests are not remembered, duplicates in later chunks try again
+    run_answers.update({text: answer for text, answer in answers.items() if not is_failed_answer(answer)})
+    while len(run_answers) > config.AI_RUN_MEMO_MAX_TEXTS:
+        run_answers.popitem(last=False)
+
+    return [answers[text] if text in answers else known[text] for text in texts]
+
+
+def escalates(text, answer):
+    """
+    True if an answer of the small model goes to the large model: failed, no valid year or low confidence.
+    """
+    if is_failed_answer(answer):
+        return True
+    year, confidence = validate_answer(answer, text)
+    return not is_valid_year(year) or confidence < config.AI_CASCADE_MIN_CONFIDENCE
+
+
+async def ask_ai_cascade(session, texts, on_answer=None):
+    """
+    Asks the small model (AI_SMALL_MODEL_NAME) first and the large model only for escalated texts.
+    Returns (answers, tiers) per row, tier is "AI_SMALL" or "AI_LARGE". on_answer(text, answer, tier)
+    is called once per distinct text with its final answer.
+    """
+    metrics = get_metrics()
+
+    def small_answer(text, answer):
+        if on_answer is not None and not escalates(text, answer):
+            on_answer(text, answer, "AI_SMALL")
+
+    start = time.perf_counter()
+    with metrics.stage("ai_small"):
+        small_answers = await ask_ai_for_unique_texts(session, texts, on_answer=small_answer, model=config.AI_SMALL_MODEL_NAME)
+    small_seconds = time.perf_counter() - start
+
+    unique_count = len(set(texts))
+    escalated = list(dict.fromkeys(text for text, answer in zip(texts, small_answers) if escalates(text, answer)))
+    large_answer = None if on_answer is None else lambda text, answer: on_answer(text, answer, "AI_LARGE")
+
+    start = time.perf_counter()
+    with metrics.stage("ai_large"):
+        large_answers = dict(zip(escalated, await ask_ai_for_unique_texts(session, escalated, on_answer=large_answer)))
+    large_seconds = time.perf_counter() - start
+
+    metrics.count("ai_small_texts", unique_count)
+    metrics.count("ai_escalated_texts", len(escalated))
+    escalation_rate = len(escalated) / unique_count * 100 if unique_count else 0.0
+    latency = {model: total / count for model, (count, total) in metrics.model_latency.items() if count}
+    logger.info(f"AI cascade: {len(escalated)}/{unique_count} distinct texts escalated ({escalation_rate:.1f}%), "
+                f"small model {small_seconds:.2f}s (mean request {latency.get(config.AI_SMALL_MODEL_NAME, 0):.2f}s), "
+                f"large model {large_seconds:.2f}s (mean request {latency.get(config.AI_MODEL_NAME, 0):.2f}s).")
+
+    answers = [large_answers.get(text, small) for text, small in zip(texts, small_answers)]
+    tiers = ["AI_LARGE" if text in large_answers else "AI_SMALL" for text in texts]
+    return answers, tiers
+
+
+def extract_rule_years(df):
+    """
+    Rule based search and candidate filter of a chunk, without I/O (runs in a thread in PIPELINE_MODE).
+    Returns (rule-resolved rows, rows without year candidate, rows for the AI).
+    """
+    metrics = get_metrics()
+
     # RULE BASED SEARCH
-    df['year'] = df['combined'].apply(extract_latest_year).astype("string")
+    with metrics.stage("rules"):
+        df['year'] = extract_latest_years(df['combined'])
+    metrics.add_rule_hits(df['combined'], df['year'])
 
     df_remaining = df[df['year'] == ""].copy().astype("string")
     df_done = df[df['year'] != ""].copy().astype("string")
     df_done["origin"] = "RULE"
+    df_done["confidence"] = 1.0
 
-    logger.info(f"Processing {len(df)} by rules: {len(df_done)} done, {len(df_remaining)} remaining.")
+    # CANDIDATE FILTER - rows without any number that could be a year are not sent to the AI
+    df_filtered = df_remaining.iloc[0:0]
+    if config.ENABLE_AI_PROCESS and config.ENABLE_AI_CANDIDATE_FILTER:
+        with metrics.stage("filter"):
+            candidates = has_year_candidates(df_remaining['combined']).to_numpy()
+        df_filtered = df_remaining[~candidates].copy()
+        df_filtered["year"] = config.NOT_FOUND_RETURN_VALUE
+        df_filtered["origin"] = "FILTER"
+        df_filtered["confidence"] = 1.0
+        df_remaining = df_remaining[candidates].copy()
+        metrics.count("filter_rows", len(df_filtered))
 
-    # AI SEARCH - PROCESS IF RULE BASED SEARCH DID NOT FIND A YEAR
-    if config.ENABLE_AI_PROCESS:
-        years = []
-        total = len(df_remaining)
-        logger.info(f"Processing remaing {len(df_remaining)} with AI.")
+    logger.info(f"Processing {len(df)} by rules: {len(df_done)} rule-resolved, {len(df_filtered)} without year candidate, "
+                f"{len(df_remaining)} remaining.")
 
-        for idx, text in enumerate(df_remaining['combined'], start=1):
-            year = await set_prompt_text(session, text)
+    return df_done, df_filtered, df_remaining
 
-            years.append(year)
 
-            # Fortschritt ausgeben mit flush
-            if idx % 10 == 0 or idx == total:
-                logger.info(f"Processed by AI: {idx}/{total} rows ({idx / total * 100:.1f}%)")
+def journal_rule_years(df_done, df_filtered):
+    journal = get_journal()
+    if journal is not None:
+        journal.write_rows(df_done[['id', 'year', 'origin', 'confidence']].itertuples(index=False))
+        if not df_filtered.empty:
+            journal.write_rows(df_filtered[['id', 'year', 'origin', 'confidence']].itertuples(index=False))
+
+
+async def extract_ai_years(session, df_remaining):
+    """
+    AI search, validation and low confidence retries for the rows the rules could not resolve.
+    Returns these rows with year, confidence and origin, rows without answer (failed or pending) are left out.
+    """
+    metrics = get_metrics()
+    journal = get_journal()
+    logger.info(f"Processing remaing {len(df_remaining)} with AI ({int(get_limiter().limit)} parallel requests, batch size {config.AI_BATCH_SIZE}).")
+
+    texts = df_remaining['combined'].fillna("").tolist()
+    ids_by_text = {}
+    for row_id, text in zip(df_remaining['id'], texts):
+        ids_by_text.setdefault(text, []).append(row_id)
+
+    origin_by_text = {}
+
+    def journal_result(text, year, confidence):
+        if journal is not None:
+            origin = origin_by_text.get(text, "AI")
+            journal.write_rows((row_id, accepted_year(year, confidence), origin, confidence) for row_id in ids_by_text[text])
+
+    # every validated answer goes to the journal right away, failed rows are retried by the next run
+    def on_answer(text, answer, tier="AI"):
+        origin_by_text[text] = tier
+        if not is_failed_answer(answer):
+            year, confidence = validate_answer(answer, text)
+            if not needs_retry(year, confidence):
+                journal_result(text, year, confidence)
+
+    with metrics.stage("ai"):
+        if config.AI_CASCADE:
+            answers, origins = await ask_ai_cascade(session, texts, on_answer=on_answer)
+        else:
+            answers = await ask_ai_for_unique_texts(session, texts, on_answer=on_answer)
+            origins = "AI"
+    metrics.count("ai_rows", len(texts))
 
-        df_remaining['year'] = years
+    # VALIDATION - (year, confidence) per distinct text
+    results = {text: validate_answer(answer, text) for text, answer in zip(texts, answers)}
 
-        df_remaining["year"] = (
-            df_remaining["year"]
-            .astype(str)  # falls None oder andere Typen
-            .str.extract(r"(\d{4})")[0]  # extrahiert 4-stellige Zahl oder NaN
-            .fillna(config.NOT_FOUND_RETURN_VALUE)  # ersetzt alle NaN durch leeren String
-        )
+    retry_texts = [text for text, (year, confidence) in results.items() if needs_retry(year, confidence)]
+    if retry_texts:
+        logger.info(f"Retry {len(retry_texts)} low confidence answers with stricter prompt.")
+        with metrics.stage("ai"):
+            retry_answers = await ask_ai_for_years(session, retry_texts, template=PROMPT_TEMPLATE_STRICT, batch_size=1)
+        metrics.count("ai_retries", len(retry_texts))
 
-        df_remaining["year"] = df_remaining["year"].apply(lambda y: y if is_valid_year(y) else "0")
-        df_remaining["year"] = df_remaining["year"].astype("string")
-        df_remaining["origin"] = "AI"
+        improved = 0
+        for text, answer in zip(retry_texts, retry_answers):
+            if not is_failed_answer(answer):
+                year, confidence = validate_answer(answer, text)
+                if confidence > results[text][1]:
+                    results[text] = (year, confidence)
+                    improved += 1
+            journal_result(text, *results[text])
+        logger.info(f"Retry improved {improved}/{len(retry_texts)} answers.")
 
+    rejected = sum(1 for year, confidence in results.values() if accepted_year(year, confidence) != year)
+    metrics.count("ai_rejected", rejected)
+    logger.info(f"AI validation: {rejected}/{len(results)} distinct answers below confidence {config.AI_MIN_CONFIDENCE} set to 0.")
 
+    df_remaining["year"] = pd.array([accepted_year(*results[text]) for text in texts], dtype="string")
+    df_remaining["confidence"] = [results[text][1] for text in texts]
+    df_remaining["origin"] = origins
+
+    # rows without answer (all retries failed or time budget exceeded) are no "not found" results, they are left out
+    # of the output and the journal and processed again by a later pass or run
+    failed = [is_failed_answer(answer) for answer in answers]
+    if any(failed):
+        df_remaining = df_remaining[[not row_failed for row_failed in failed]]
+        metrics.count("ai_failed_rows", sum(failed))
+        logger.warning(f"AI requests for {sum(failed)} rows failed or are pending, they are processed again later.")
+    return df_remaining
+
+
+# ASYNCHRON VERSION
+async def extracting_year_and_write_csv(session, df):
+    df_done, df_filtered, df_remaining = extract_rule_years(df)
+    journal_rule_years(df_done, df_filtered)
+
+    # AI SEARCH - PROCESS IF RULE BASED SEARCH DID NOT FIND A YEAR
+    if config.ENABLE_AI_PROCESS:
+        df_remaining = await extract_ai_years(session, df_remaining)
 
     #concat all df results for csv output
-    df_merged = pd.concat([df_done, df_remaining], ignore_index=True).drop_duplicates()
+    df_merged = pd.concat([df_done, df_filtered, df_remaining], ignore_index=True).drop_duplicates()
     return df_merged
 
 if __name__=="__main__":